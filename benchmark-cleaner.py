@@ -0,0 +1,59 @@
+import sys
+import time
+import difflib
+import lxml.etree as etree
+from wiki_text import clean_wiki_text, strip_wiki_markup
+
+# MediaWiki XML file to benchmark on, can be overridden on the command line
+XML_PATH = 'wikipedia-cleaning/test_data.xml'
+
+# Number of passes over the articles for each cleaner
+NUM_ROUNDS = 5
+
+
+def load_articles(xml_path):
+    """
+    Returns the text of every non-redirect page in the main namespace of a MediaWiki XML file.
+    """
+    articles = []
+    for _, page in etree.iterparse(xml_path, tag='{*}page'):
+        ns = page.findtext('{*}ns')
+        redirect = page.find('{*}redirect')
+        text = page.findtext('{*}revision/{*}text')
+        if ns == '0' and redirect is None and text:
+            articles.append(text)
+        page.clear()
+    return articles
+
+
+def time_cleaner(articles, fast):
+    """
+    Cleans every article NUM_ROUNDS times and returns the cleaned texts and the articles per second.
+    """
+    start_time = time.perf_counter()
+    for _ in range(NUM_ROUNDS):
+        cleaned = [clean_wiki_text(article, fast=fast) for article in articles]
+    elapsed_time = time.perf_counter() - start_time
+    return cleaned, NUM_ROUNDS * len(articles) / elapsed_time
+
+
+def main():
+    xml_path = sys.argv[1] if len(sys.argv) > 1 else XML_PATH
+    articles = load_articles(xml_path)
+    num_fallbacks = sum(strip_wiki_markup(article) is None for article in articles)
+
+    reference, reference_speed = time_cleaner(articles, fast=False)
+    fast, fast_speed = time_cleaner(articles, fast=True)
+
+    # Word-level similarity of the fast output to the mwparserfromhell output
+    similarities = [difflib.SequenceMatcher(None, a.split(), b.split(), autojunk=False).ratio()
+                    for a, b in zip(reference, fast)]
+
+    print(f"Articles: {len(articles)} ({num_fallbacks} fell back to mwparserfromhell)")
+    print(f"mwparserfromhell: {reference_speed:.1f} articles/sec")
+    print(f"Fast path:        {fast_speed:.1f} articles/sec ({fast_speed / reference_speed:.1f}x)")
+    print(f"Similarity:       mean {sum(similarities) / len(similarities):.4f}, min {min(similarities):.4f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import numpy as np
+import lxml.etree as etree
+import pyarrow.parquet as pq
+from wiki_text import clean_wiki_text, split_text_into_chunks
+from encoders import (SentenceTransformerEncoder, OnnxEncoder, ENCODER_MODEL, ONNX_MODEL_PATH, MAX_BATCH_TOKENS,
+                      MAX_BATCH_SIZE)
+from encoder_pool import EncoderPool
+from sharding import list_row_groups
+
+# Chunks are taken from the Parquet files of extract-wiki-2.0.py if there are any,
+# else made from the fixture, which can be overridden on the command line
+PARQUET_PATH = 'wiki_parquet/'
+XML_PATH = 'wikipedia-cleaning/test_data.xml'
+
+NUM_CHUNKS = 512
+
+# Fixed-count batches in article order, the way chunks were encoded before token-budget batching
+FIXED_BATCH_SIZE = 64
+
+# ONNX Runtime intra-op thread counts to try
+THREAD_COUNTS = sorted({1, 2, 4, os.cpu_count() or 1})
+
+# Numbers of model replicas tried for the encoder pool, each with the cores divided among them
+POOL_SIZES = [n for n in (2, 4, 8, 16, 32) if n <= (os.cpu_count() or 1)]
+
+
+def load_chunks(xml_path):
+    """
+    Returns up to NUM_CHUNKS chunks, from the Parquet output if there is one, else from the articles of xml_path.
+    """
+    if os.path.isdir(PARQUET_PATH):
+        row_groups = list_row_groups(PARQUET_PATH)
+        if row_groups:
+            file_path, i = row_groups[0]
+            table = pq.ParquetFile(file_path).read_row_group(i, columns=['chunks'])
+            return table.column('chunks').to_pylist()[:NUM_CHUNKS]
+
+    chunks = []
+    for _, page in etree.iterparse(xml_path, tag='{*}page'):
+        text = page.findtext('{*}revision/{*}text')
+        if page.findtext('{*}ns') == '0' and page.find('{*}redirect') is None and text:
+            chunks.extend(split_text_into_chunks(clean_wiki_text(text)))
+        page.clear()
+    return chunks[:NUM_CHUNKS]
+
+
+def time_encoder(encoder, chunks, max_batch_tokens=MAX_BATCH_TOKENS):
+    """
+    Encodes the chunks once to warm up, then again timed, and returns the embeddings and chunks per second.
+    With max_batch_tokens None, uses fixed batches of FIXED_BATCH_SIZE chunks instead of token-budget batches.
+    """
+    batch_size = FIXED_BATCH_SIZE if max_batch_tokens is None else MAX_BATCH_SIZE
+    encoder.encode(chunks[:FIXED_BATCH_SIZE], max_batch_tokens=max_batch_tokens, max_batch_size=batch_size)
+    start_time = time.perf_counter()
+    embeddings = encoder.encode(chunks, max_batch_tokens=max_batch_tokens, max_batch_size=batch_size)
+    return embeddings, len(chunks) / (time.perf_counter() - start_time)
+
+
+def get_cosine_agreement(embeddings, reference):
+    """
+    Returns the cosine similarity of every embedding with the reference embedding of the same chunk.
+    """
+    embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    return (embeddings * reference).sum(axis=1)
+
+
+def benchmark_pools(chunks, backend, reference, reference_speed):
+    """
+    Times the encoder pool of the given backend at every size in POOL_SIZES, in float32 and float16.
+    """
+    for num_workers in POOL_SIZES:
+        threads_per_worker = max((os.cpu_count() or 1) // num_workers, 1)
+        for dtype in ('float32', 'float16'):
+            pool = EncoderPool(backend, num_workers=num_workers, threads_per_worker=threads_per_worker, dtype=dtype)
+            try:
+                embeddings, speed = time_encoder(pool, chunks)
+            finally:
+                pool.close()
+            agreement = get_cosine_agreement(embeddings.astype(np.float32), reference)
+            print(f"{backend} pool ({num_workers:2d} workers x {threads_per_worker:2d} threads, {dtype}): "
+                  f"{speed:8.1f} chunks/sec ({speed / reference_speed:.1f}x the reference), "
+                  f"cosine vs reference min {agreement.min():.4f}")
+
+
+def main():
+    chunks = load_chunks(sys.argv[1] if len(sys.argv) > 1 else XML_PATH)
+    print(f"{len(chunks)} chunks, model {ENCODER_MODEL}")
+
+    reference_encoder = SentenceTransformerEncoder(device='cpu')
+    _, fixed_speed = time_encoder(reference_encoder, chunks, max_batch_tokens=None)
+    print(f"sentence-transformers (cpu), {FIXED_BATCH_SIZE} per batch:      {fixed_speed:8.1f} chunks/sec")
+    reference, reference_speed = time_encoder(reference_encoder, chunks)
+    print(f"sentence-transformers (cpu), token budget: {reference_speed:8.1f} chunks/sec "
+          f"({reference_speed / fixed_speed:.1f}x)")
+
+    benchmark_pools(chunks, 'sentence-transformers', reference, reference_speed)
+
+    if not os.path.isfile(ONNX_MODEL_PATH):
+        print(f"{ONNX_MODEL_PATH} not found, run convert-to-onnx.py first")
+        return
+    for num_threads in THREAD_COUNTS:
+        encoder = OnnxEncoder(num_threads=num_threads)
+        _, fixed_speed = time_encoder(encoder, chunks, max_batch_tokens=None)
+        embeddings, speed = time_encoder(encoder, chunks)
+        agreement = get_cosine_agreement(embeddings, reference)
+        print(f"onnx int8 ({num_threads:2d} threads): {fixed_speed:8.1f} chunks/sec with {FIXED_BATCH_SIZE} per batch, "
+              f"{speed:8.1f} with the token budget ({speed / reference_speed:.1f}x the reference), "
+              f"cosine vs reference mean {agreement.mean():.4f}, min {agreement.min():.4f}")
+    benchmark_pools(chunks, 'onnx', reference, reference_speed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import importlib.util
+import statistics
+import subprocess
+import numpy as np
+import pyarrow as pa
+from wiki_dump import (find_dump_parts, build_offset_index, load_offset_index, get_stream_ranges, open_dump,
+                       read_stream, decompress_stream, parse_pages)
+from wiki_text import clean_wiki_text, split_text_into_chunks
+from parquet_sink import (ParquetShardWriter, PARQUET_SCHEMA, PARQUET_COMPRESSION, PARQUET_COMPRESSION_LEVEL,
+                          TARGET_SHARD_BYTES, ROW_GROUP_SIZE)
+from encoders import ENCODER_BACKEND, ENCODER_BACKENDS, ENCODER_WORKERS, ONNX_MODEL_PATH, load_encoder
+from synthetic_dump import generate_dump
+from pg_copy import copy_rows, encode_text, encode_vector
+
+# Size of the synthetic dump generated when no --dump-dir is given
+NUM_PAGES = 5000
+NUM_PARTS = 2
+
+# Number of timed runs of every benchmark; the best one is reported
+NUM_ROUNDS = 3
+
+# Encoding and DB loading run on a sample of the chunks, as they are much slower than the other stages.
+# Encoding uses the encoder configured in encoders.py, as create-wiki-vdb-2.0.py does
+ENCODE_SAMPLE_SIZE = 1024
+DB_SAMPLE_SIZE = 20_000
+DB_TABLE_NAME = 'benchmark_wikipedia'
+
+# A benchmark this much slower than the baseline counts as a regression
+TOLERANCE = 0.15
+
+
+def time_rounds(function, rounds):
+    """
+    Calls function rounds times and returns the best and the median time in seconds.
+    """
+    times = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return min(times), statistics.median(times)
+
+
+def run_benchmark(results, name, function, rounds, items, unit, num_bytes=None):
+    best, median = time_rounds(function, rounds)
+    result = {'seconds': best, 'median_seconds': median, 'items': items, 'unit': unit,
+              'items_per_sec': items / max(best, 1e-9)}
+    if num_bytes is not None:
+        result['mb_per_sec'] = num_bytes / 1e6 / max(best, 1e-9)
+    results[name] = result
+    throughput = f"{result['items_per_sec']:12.1f} {unit}/sec"
+    if num_bytes is not None:
+        throughput += f" {result['mb_per_sec']:8.1f} MB/sec"
+    print(f"{name:>16}: {throughput}  (best {best:.3f}s, median {median:.3f}s)")
+
+
+def benchmark_extraction(results, dump_dir, prefix, rounds):
+    """
+    Times every extraction stage on the whole dump, each on the output of the previous one.
+    """
+    parts = find_dump_parts(dump_dir, prefix)
+    if not parts:
+        raise SystemExit(f"No dump parts found in {dump_dir}")
+
+    def _build_indexes():
+        for part in parts:
+            shutil.rmtree(part.index_cache_path, ignore_errors=True)
+            build_offset_index(part.index_path, part.article_path, part.index_cache_path)
+    indexes = [load_offset_index(part.index_path, part.article_path, part.index_cache_path) for part in parts]
+    num_pages = sum(len(index.page_ids) for index in indexes)
+    run_benchmark(results, 'build_index', _build_indexes, rounds, num_pages, 'pages')
+    run_benchmark(results, 'load_index', lambda: [get_stream_ranges(load_offset_index(
+        part.index_path, part.article_path, part.index_cache_path)) for part in parts], rounds, num_pages, 'pages')
+
+    dumps = [open_dump(part.article_path) for part in parts]
+    stream_ranges = [(dump, start, end) for dump, index in zip(dumps, indexes) for start, end in get_stream_ranges(index)]
+    compressed = [read_stream(dump, start, end) for dump, start, end in stream_ranges]
+    xmls = [decompress_stream(stream) for stream in compressed]
+    num_compressed_bytes = sum(len(stream) for stream in compressed)
+    num_xml_bytes = sum(len(xml) for xml in xmls)
+    run_benchmark(results, 'read', lambda: [read_stream(*stream_range) for stream_range in stream_ranges],
+                  rounds, len(stream_ranges), 'streams', num_compressed_bytes)
+    run_benchmark(results, 'decompress', lambda: [decompress_stream(stream) for stream in compressed],
+                  rounds, len(compressed), 'streams', num_xml_bytes)
+    run_benchmark(results, 'parse', lambda: [parse_pages(xml) for xml in xmls], rounds, len(xmls), 'streams',
+                  num_xml_bytes)
+
+    dfs = [parse_pages(xml) for xml in xmls]
+    articles = [article for df in dfs for article in df['article']]
+    num_article_bytes = sum(len(article.encode('utf-8')) for article in articles)
+    run_benchmark(results, 'clean', lambda: [clean_wiki_text(article) for article in articles],
+                  rounds, len(articles), 'articles', num_article_bytes)
+
+    texts = [clean_wiki_text(article) for article in articles]
+    run_benchmark(results, 'chunk', lambda: [split_text_into_chunks(text) for text in texts],
+                  rounds, len(texts), 'articles', sum(len(text.encode('utf-8')) for text in texts))
+
+    ids, revisions, titles, chunks = [], [], [], []
+    for df, df_texts in zip(dfs, _split_like(texts, dfs)):
+        for page_id, revision, title, text in zip(df['index'], df['revision'], df['title'], df_texts):
+            text_chunks = split_text_into_chunks(text)
+            ids.extend([page_id] * len(text_chunks))
+            revisions.extend([revision] * len(text_chunks))
+            titles.extend([title] * len(text_chunks))
+            chunks.extend(text_chunks)
+    table = pa.table({'index': pa.array(ids, pa.int32()), 'revision': pa.array(revisions, pa.int64()),
+                      'title': titles, 'chunks': chunks}, schema=PARQUET_SCHEMA)
+
+    def _write_parquet():
+        output_dir = tempfile.mkdtemp(prefix='benchmark-parquet-')
+        try:
+            writer = ParquetShardWriter(output_dir, PARQUET_SCHEMA, TARGET_SHARD_BYTES, ROW_GROUP_SIZE,
+                                        compression=PARQUET_COMPRESSION, compression_level=PARQUET_COMPRESSION_LEVEL,
+                                        dictionary_columns=['title'])
+            writer.write(table, 'benchmark')
+            writer.close()
+        finally:
+            shutil.rmtree(output_dir)
+    run_benchmark(results, 'parquet_write', _write_parquet, rounds, table.num_rows, 'chunks', table.nbytes)
+    return chunks
+
+
+def _split_like(items, dfs):
+    """
+    Splits a flat list back into one list per DataFrame, following their lengths.
+    """
+    position = 0
+    for df in dfs:
+        yield items[position:position + len(df)]
+        position += len(df)
+
+
+def benchmark_encode(results, chunks, rounds, backend, num_workers):
+    """
+    Times encoding a sample of the chunks with the encoder create-wiki-vdb-2.0.py loads, tokenizing and
+    token-budget batching included, without the embedding cache. Skipped if the backend isn't installed.
+    """
+    # Checked up front, as the workers of an encoder pool would fail to start without saying why
+    module = 'onnxruntime' if backend == 'onnx' else 'sentence_transformers'
+    if importlib.util.find_spec(module) is None:
+        print(f"{'encode':>16}: skipped, {module} is not installed")
+        return
+    if backend == 'onnx' and not os.path.isfile(ONNX_MODEL_PATH):
+        print(f"{'encode':>16}: skipped, {ONNX_MODEL_PATH} doesn't exist, see convert-to-onnx.py")
+        return
+    encoder = load_encoder(backend, cache_path=None, num_workers=num_workers)
+    sample = chunks[:ENCODE_SAMPLE_SIZE]
+    try:
+        encoder.encode(sample[:64])
+        run_benchmark(results, 'encode', lambda: encoder.encode(sample), rounds, len(sample), 'chunks')
+    finally:
+        encoder.close()
+
+
+def benchmark_db_load(results, chunks, rounds):
+    """
+    Times inserting chunks with random embeddings into a scratch table of the local Postgres, with
+    INSERT ... VALUES through execute_values (db_load) and with a binary COPY (db_load_copy), the way
+    create-wiki-vdb-2.0.py does. Skipped if psycopg2 isn't installed or the database isn't configured.
+    """
+    if 'PG_VECTOR_DB_USER' not in os.environ:
+        print(f"{'db_load':>16}: skipped, PG_VECTOR_DB_USER and PG_VECTOR_DB_PASSWORD are not set")
+        return
+    try:
+        import psycopg2
+        import psycopg2.extras
+        from pgvector.psycopg2 import register_vector
+    except ImportError:
+        print(f"{'db_load':>16}: skipped, psycopg2 or pgvector is not installed")
+        return
+
+    sample = (chunks * (DB_SAMPLE_SIZE // max(len(chunks), 1) + 1))[:DB_SAMPLE_SIZE]
+    embeddings = np.random.default_rng(0).standard_normal((len(sample), 384), dtype=np.float32)
+    db_connection = psycopg2.connect(host="localhost", database="vector_db",
+                                     user=os.environ["PG_VECTOR_DB_USER"],
+                                     password=os.environ["PG_VECTOR_DB_PASSWORD"])
+    register_vector(db_connection)
+    cursor = db_connection.cursor()
+
+    def _create_table():
+        cursor.execute(f"DROP TABLE IF EXISTS {DB_TABLE_NAME}")
+        cursor.execute(f"""
+           CREATE TABLE {DB_TABLE_NAME} (
+               id SERIAL PRIMARY KEY,
+               chunk TEXT NOT NULL,
+               embedding VECTOR(384) NOT NULL
+           )
+        """)
+
+    def _load():
+        _create_table()
+        psycopg2.extras.execute_values(
+            cursor, f"INSERT INTO {DB_TABLE_NAME} (chunk, embedding) VALUES %s",
+            zip(sample, embeddings), template="(%s, %s::vector)")
+        db_connection.commit()
+
+    def _load_copy():
+        _create_table()
+        copy_rows(cursor, DB_TABLE_NAME, ['chunk', 'embedding'], [encode_text(sample), encode_vector(embeddings)])
+        db_connection.commit()
+
+    try:
+        run_benchmark(results, 'db_load', _load, rounds, len(sample), 'rows')
+        run_benchmark(results, 'db_load_copy', _load_copy, rounds, len(sample), 'rows')
+        print(f"{'':>16}  COPY is {results['db_load_copy']['items_per_sec'] / results['db_load']['items_per_sec']:.1f}x "
+              f"INSERT ... VALUES")
+    finally:
+        cursor.execute(f"DROP TABLE IF EXISTS {DB_TABLE_NAME}")
+        db_connection.commit()
+        cursor.close()
+        db_connection.close()
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def find_regressions(results, baseline_path, tolerance):
+    """
+    Returns the benchmarks whose throughput is more than tolerance below the last run recorded in baseline_path.
+    """
+    with open(baseline_path, 'r') as f:
+        lines = [line for line in f if line.strip()]
+    baseline = json.loads(lines[-1])['results']
+    regressions = []
+    for name, result in results.items():
+        if name in baseline and result['items_per_sec'] < baseline[name]['items_per_sec'] * (1 - tolerance):
+            regressions.append((name, baseline[name]['items_per_sec'], result['items_per_sec']))
+    return regressions
+
+
+def main():
+    """
+    Runs the pipeline's stages on a synthetic (or given) multistream dump and reports the throughput of each.
+    Results are appended to a JSON lines file; with --baseline, the run fails if a stage got slower.
+    """
+    parser = argparse.ArgumentParser(description="Benchmark the stages of the Wikipedia pipeline.")
+    parser.add_argument('--dump-dir', help="benchmark an existing dump instead of generating one")
+    parser.add_argument('--prefix', default='enwiki-20230301', help="file name prefix of the dump")
+    parser.add_argument('--pages', type=int, default=NUM_PAGES, help="pages in the generated dump")
+    parser.add_argument('--source', choices=['random', 'fixture'], default='random',
+                        help="wikitext of the generated dump")
+    parser.add_argument('--rounds', type=int, default=NUM_ROUNDS)
+    parser.add_argument('--encoder', choices=ENCODER_BACKENDS, default=ENCODER_BACKEND,
+                        help="encoder backend; the model is set in encoders.py")
+    parser.add_argument('--encoder-workers', type=int, default=ENCODER_WORKERS, metavar='N',
+                        help="encode with N model replicas in separate processes")
+    parser.add_argument('--skip-encode', action='store_true')
+    parser.add_argument('--skip-db', action='store_true')
+    parser.add_argument('--output', default='benchmark-results.jsonl', help="JSON lines file results are appended to")
+    parser.add_argument('--baseline', help="JSON lines file of an earlier run to compare against")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    dump_dir = args.dump_dir
+    if dump_dir is None:
+        dump_dir = tempfile.mkdtemp(prefix='benchmark-dump-')
+        generate_dump(dump_dir, args.pages, prefix=args.prefix, num_parts=NUM_PARTS, source=args.source)
+    try:
+        results = {}
+        chunks = benchmark_extraction(results, dump_dir, args.prefix, args.rounds)
+        if not args.skip_encode:
+            benchmark_encode(results, chunks, args.rounds, args.encoder, args.encoder_workers)
+        if not args.skip_db:
+            benchmark_db_load(results, chunks, args.rounds)
+    finally:
+        if args.dump_dir is None:
+            shutil.rmtree(dump_dir)
+
+    record = {'time': time.time(), 'commit': get_git_commit(), 'dump_dir': args.dump_dir,
+              'pages': None if args.dump_dir else args.pages, 'source': args.source,
+              'encoder': None if args.skip_encode else args.encoder,
+              'encoder_workers': None if args.skip_encode else args.encoder_workers, 'results': results}
+    regressions = find_regressions(results, args.baseline, args.tolerance) if args.baseline else []
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    for name, baseline_speed, speed in regressions:
+        print(f"Regression: {name} {speed:.1f}/sec, baseline {baseline_speed:.1f}/sec "
+              f"({speed / baseline_speed - 1:+.1%})")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+import os
+import time
+import argparse
+import psycopg2
+from vector_index import (VECTOR_INDEX_METHODS, VECTOR_DISTANCES, VECTOR_DISTANCE, HNSW_M, HNSW_EF_CONSTRUCTION,
+                          IVFFLAT_LISTS, create_vector_index, get_vector_index_size, get_vector_index_name)
+
+# Settings of the index build. HNSW builds are much faster while the graph fits in maintenance_work_mem
+MAINTENANCE_WORK_MEM = '2GB'
+MAINTENANCE_WORKERS = 4
+
+# Set up connection parameters
+db_connection_params = {
+    "host": "localhost",
+    "database": "vector_db",
+    "user": os.environ.get("PG_VECTOR_DB_USER"),
+    "password": os.environ.get("PG_VECTOR_DB_PASSWORD"),
+}
+
+
+def main():
+    """
+    Builds or rebuilds the ANN index of an embeddings table, e.g. after a sharded load or to try other
+    settings, and prints its build time and size.
+    """
+    parser = argparse.ArgumentParser(description="Build the ANN index on the embeddings in PostgreSQL.")
+    parser.add_argument('--table', default='wikipedia_embeddings')
+    parser.add_argument('--method', choices=[method for method in VECTOR_INDEX_METHODS if method != 'none'],
+                        default='hnsw')
+    parser.add_argument('--distance', choices=list(VECTOR_DISTANCES), default=VECTOR_DISTANCE,
+                        help="must match the operator queries order by")
+    parser.add_argument('--m', type=int, default=HNSW_M, help="HNSW links per node")
+    parser.add_argument('--ef-construction', type=int, default=HNSW_EF_CONSTRUCTION,
+                        help="HNSW candidate list size while building")
+    parser.add_argument('--lists', type=int, default=IVFFLAT_LISTS,
+                        help="IVFFlat lists (default: from the number of rows)")
+    parser.add_argument('--keep', action='store_true', help="keep an existing index instead of rebuilding it")
+    args = parser.parse_args()
+
+    db_connection = psycopg2.connect(**db_connection_params)
+    cursor = db_connection.cursor()
+    cursor.execute("SET maintenance_work_mem = %s", (MAINTENANCE_WORK_MEM,))
+    cursor.execute("SET max_parallel_maintenance_workers = %s", (MAINTENANCE_WORKERS,))
+
+    start_time = time.time()
+    result = create_vector_index(cursor, args.table, args.method, args.distance, args.m, args.ef_construction,
+                                 args.lists, replace=not args.keep)
+    db_connection.commit()
+    if result is None:
+        size = get_vector_index_size(cursor, args.table)
+        print(f"Kept {get_vector_index_name(args.table)}, {size / 2 ** 20:.1f} MiB")
+    cursor.execute(f"ANALYZE {args.table}")
+    db_connection.commit()
+    print(f"Script execution time: {time.time() - start_time} seconds")
+
+    cursor.close()
+    db_connection.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,131 +1,728 @@
 import os
+import queue
+import hashlib
+import argparse
+import threading
 from pgvector.psycopg2 import register_vector
 import psycopg2.extras
 import psycopg2
-from sentence_transformers import SentenceTransformer
+import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
+import pyarrow.fs
 import pyarrow.parquet as pq
 from tqdm import tqdm
-import multiprocessing as mp
 import time
-import json
 import openai
 from dotenv import load_dotenv
+from functools import partial
+from typing import List, NamedTuple, Optional, Tuple
+from sharding import add_shard_arguments, check_shard_arguments, select_shard, get_shard_suffix, list_row_groups
+from dedup import hash_chunk, find_near_duplicates
+from metrics import PipelineMetrics
+from encoders import Encoder, ENCODER_BACKEND, ENCODER_BACKENDS, ENCODER_WORKERS, load_encoder
+from pipeline_stages import iter_in_background
+from pg_copy import copy_rows, encode_bytea, encode_int4, encode_int8, encode_text, encode_vector
+from embedding_sidecars import SIDECAR_DIR_NAME, SIDECAR_DTYPE, SidecarReader, get_sidecar_path, is_sidecar_current, \
+    write_sidecar
+from vector_index import VECTOR_INDEX, VECTOR_INDEX_METHODS, check_vector_dimension, create_vector_index
 
 table_name = "wikipedia"  # Set your desired table name here
 
+# Chunks are encoded once per distinct normalized text and stored in {table_name}_embeddings,
+# which the chunk rows reference by hash. Set to a Jaccard similarity (e.g. 0.9) to also let
+# near-duplicate chunks within a batch share the embedding of the first one, found with MinHash
+NEAR_DUPLICATE_THRESHOLD = None
 
-# Start the timer
-start_time = time.time()
+# Directory of Parquet files written by extract-wiki-2.0.py, changed with --parquet-dir
+parquet_path = 'wiki_parquet/'
 
-# # Read the parquet file into a pandas DataFrame
-file_path = 'wiki_parquet/00000012.parquet'
-parquet_file = pq.ParquetFile(file_path)
-df = parquet_file.read_row_group(0).to_pandas()
+# Row groups are streamed in batches of this many chunks, so memory use doesn't depend on the size
+# of the corpus. Each row group is committed in one transaction together with its progress record
+BATCH_ROWS = 10_000
+PARQUET_COLUMNS = ['index', 'revision', 'title', 'chunks']
+# Token ids stored by extract-wiki-2.0.py --pretokenize, used instead of tokenizing when they come from
+# the encoder's tokenizer
+TOKEN_IDS_COLUMN = 'input_ids'
 
-pd.set_option('display.max_colwidth', 0)
-print(df['chunks'].head(10))
-exit()
+# Rows are loaded with COPY ... (FORMAT BINARY), with the embeddings in pgvector's binary format.
+# 'values' uses INSERT ... VALUES through execute_values instead, which is several times slower
+LOAD_METHOD = 'copy'
+LOAD_METHODS = ('copy', 'values')
 
-# Read the JSON file into a pandas DataFrame
-# with open('output.json', 'r') as file:
-#     data = json.load(file)
-# formatted_data = []
-# for title, chunks in data.items():
-#     for chunk in chunks:
-#         formatted_data.append({"title": title, "chunks": chunk})
-# df = pd.DataFrame(formatted_data)
+# With --bulk, a fresh load is spread over this many connections, each copying its own batches into
+# UNLOGGED tables. The indexes of the chunk table are built once at the end, with these settings
+LOAD_CONNECTIONS = 4
+BULK_MAINTENANCE_WORK_MEM = '2GB'
+BULK_MAINTENANCE_WORKERS = 4
 
+# Reading, deduplicating and tokenizing, encoding and inserting run in their own threads on successive
+# batches, with at most this many batches waiting between two stages
+QUEUE_SIZE = 2
 
-# OPTION Use ADA-002 API for embeddings
-# load_dotenv()
-# openai.api_key = os.environ.get("OPENAI_API_KEY")
-# response = openai.Embedding.create(
-#     model="text-embedding-ada-002",
-#     input=df['chunks'].tolist()
-# )
-# embeddings = [item['embedding'] for item in response['data']]
-# df['embedding'] = list(embeddings)
+# Set up connection parameters
+db_connection_params = {
+    "host": "localhost",
+    "database": "vector_db",
+    "user": os.environ.get("PG_VECTOR_DB_USER"),
+    "password": os.environ.get("PG_VECTOR_DB_PASSWORD"),
+}
 
-# Initialize the transformer model
-# model = SentenceTransformer('multi-qa-MiniLM-L6-cos-v1', device='cuda')
-model = SentenceTransformer(
-    'sentence-transformers/msmarco-distilbert-base-tas-b', device='cuda')
-model.max_seq_length = 512
 
-# Define the batch size
-batch_size = 64
+def create_tables(cursor, drop: bool, dimension: int, bulk: bool = False) -> None:
+    """
+    Creates the chunk, embedding and progress tables, after dropping them if drop is set.
+    The embedding column is declared with the encoder's dimension, which an ANN index needs.
+    For a bulk load, the chunk and embedding tables are UNLOGGED and the chunk table gets no indexes;
+    finish_bulk_load makes them logged and builds the indexes once all rows are in.
+    """
+    unlogged = 'UNLOGGED' if bulk else ''
+    if drop:
+        cursor.execute(f"""
+           DROP TABLE IF EXISTS {table_name}, {table_name}_embeddings, {table_name}_progress
+        """)
 
-# Extract the chunks to a list
-chunks = df['chunks'].tolist()
+    # One row per distinct chunk text with its embedding, and one row per chunk
+    # of every article, pointing to its embedding
+    cursor.execute(f"""
+       CREATE {unlogged} TABLE IF NOT EXISTS {table_name}_embeddings (
+           chunk_hash BYTEA PRIMARY KEY,
+           embedding VECTOR({int(dimension)}) NOT NULL
+       )
+    """)
+    check_vector_dimension(cursor, f'{table_name}_embeddings', dimension)
+    cursor.execute(f"""
+       CREATE {unlogged} TABLE IF NOT EXISTS {table_name} (
+           id SERIAL {'' if bulk else 'PRIMARY KEY'},
+           page_id INTEGER NOT NULL,
+           revision BIGINT NOT NULL,
+           title TEXT NOT NULL,
+           chunk TEXT NOT NULL,
+           embedding_hash BYTEA NOT NULL
+       )
+    """)
+    if not bulk:
+        create_indexes(cursor)
 
-# Compute embeddings for each chunk in the DataFrame
-embeddings = model.encode(chunks, batch_size=batch_size,
-                          convert_to_numpy=True, show_progress_bar=True)
+    # Row groups whose chunks are loaded, committed in the same transaction as the chunks themselves
+    cursor.execute(f"""
+       CREATE TABLE IF NOT EXISTS {table_name}_progress (
+           file TEXT NOT NULL,
+           row_group INTEGER NOT NULL,
+           rows INTEGER NOT NULL,
+           PRIMARY KEY (file, row_group)
+       )
+    """)
 
-# Assign the embeddings back to the DataFrame
-df['embedding'] = list(embeddings)
 
-print(df)
+def create_indexes(cursor) -> None:
+    cursor.execute(f"""
+       CREATE INDEX IF NOT EXISTS {table_name}_page_id_idx ON {table_name} (page_id)
+    """)
+    cursor.execute(f"""
+       CREATE INDEX IF NOT EXISTS {table_name}_embedding_hash_idx ON {table_name} (embedding_hash)
+    """)
+
+
+def finish_bulk_load(cursor, metrics: PipelineMetrics) -> None:
+    """
+    Makes the tables of a bulk load logged, then builds the chunk table's indexes in one pass each,
+    with BULK_MAINTENANCE_WORK_MEM and up to BULK_MAINTENANCE_WORKERS parallel workers per index.
+    SET LOGGED rewrites a table together with its indexes, so it comes before the index builds.
+    """
+    cursor.execute("SET maintenance_work_mem = %s", (BULK_MAINTENANCE_WORK_MEM,))
+    cursor.execute("SET max_parallel_maintenance_workers = %s", (BULK_MAINTENANCE_WORKERS,))
+    for name in (f'{table_name}_embeddings', table_name):
+        with metrics.stage('set_logged'):
+            start_time = time.perf_counter()
+            cursor.execute(f"ALTER TABLE {name} SET LOGGED")
+            print(f"{name} set logged in {time.perf_counter() - start_time:.1f} seconds")
+    with metrics.stage('index_build'):
+        start_time = time.perf_counter()
+        cursor.execute(f"ALTER TABLE {table_name} ADD PRIMARY KEY (id)")
+        create_indexes(cursor)
+        print(f"Indexes built in {time.perf_counter() - start_time:.1f} seconds")
+    cursor.execute(f"ANALYZE {table_name}_embeddings")
+    cursor.execute(f"ANALYZE {table_name}")
+
+
+def build_vector_index(cursor, method: str, metrics: PipelineMetrics) -> None:
+    """
+    Builds the ANN index on {table_name}_embeddings once the rows are loaded, which is much faster than
+    maintaining it row by row during the load. A table that already has one, e.g. for an incremental
+    load, keeps it, as the inserts updated it.
+    """
+    cursor.execute("SET maintenance_work_mem = %s", (BULK_MAINTENANCE_WORK_MEM,))
+    cursor.execute("SET max_parallel_maintenance_workers = %s", (BULK_MAINTENANCE_WORKERS,))
+    with metrics.stage('vector_index_build') as counts:
+        result = create_vector_index(cursor, f'{table_name}_embeddings', method)
+        if result is not None:
+            counts['bytes'] = result[1]
+
+
+def create_staging_table(cursor) -> None:
+    """
+    Creates the session's temporary table new embeddings are copied into before being added to
+    {table_name}_embeddings, as COPY can't skip the chunks another shard stored in the meantime.
+    """
+    cursor.execute(f"""
+       CREATE TEMPORARY TABLE IF NOT EXISTS {table_name}_embeddings_staging
+       (LIKE {table_name}_embeddings INCLUDING DEFAULTS)
+    """)
+
+
+def get_progress_file(file_path: str) -> str:
+    """
+    Returns the name the row groups of a Parquet file are recorded under in {table_name}_progress: the file
+    name and a hash of the file's footer. Every dump's extraction reuses the same file names, and the footer,
+    which holds the sizes and statistics of every row group, tells this dump's files from last month's.
+    """
+    with open(file_path, 'rb') as f:
+        f.seek(-8, os.SEEK_END)
+        footer_size = int.from_bytes(f.read(4), 'little')
+        f.seek(-8 - footer_size, os.SEEK_END)
+        footer = f.read(footer_size)
+    return f'{os.path.basename(file_path)}:{hashlib.sha256(footer).hexdigest()[:16]}'
+
+
+def get_loaded_row_groups(cursor) -> set:
+    cursor.execute(f"SELECT file, row_group FROM {table_name}_progress")
+    return set(cursor.fetchall())
+
+
+def delete_changed_pages(cursor, parquet_dir: str) -> None:
+    """
+    Removes the rows of pages that changed or were deleted since the previous load. Rows already
+    carrying the new revision are kept, so shards can run this in any order with their inserts,
+    and a resumed run can run it again.
+    """
+    page_changes = pq.read_table(os.path.join(parquet_dir, 'changes', 'page_changes.parquet'),
+                                 columns=['index', 'revision']).to_pandas()
+    cursor.execute(f"""
+       DELETE FROM {table_name} AS w
+       USING unnest(%s::integer[], %s::bigint[]) AS c(page_id, revision)
+       WHERE w.page_id = c.page_id AND w.revision <> c.revision
+    """, (page_changes['index'].tolist(), page_changes['revision'].tolist()))
+    print(f"Deleted {cursor.rowcount} rows of changed or deleted pages")
+
+
+class Batch(NamedTuple):
+    """
+    A batch of chunks of one row group on its way through the stages. A batch without df marks the end
+    of its row group. new_chunks are the distinct chunks whose embedding isn't stored yet; the
+    embeddings of those marked in_sidecar are read from the row group's sidecar file rather than encoded,
+    and token_ids are those of the others.
+    """
+    file_path: str
+    row_group: int
+    df: Optional[pd.DataFrame]
+    new_chunks: Optional[pd.DataFrame] = None
+    in_sidecar: Optional[np.ndarray] = None
+    sidecar_embeddings: Optional[np.ndarray] = None
+    token_ids: Optional[List[List[int]]] = None
+    embeddings: Optional[np.ndarray] = None
+
+
+class PendingHashes:
+    """
+    Hashes of the chunks sent to be encoded but whose embeddings aren't committed yet. They aren't in
+    {table_name}_embeddings for the dedup stage to find, so it checks here too, and doesn't encode a chunk twice.
+    """
+
+    def __init__(self):
+        self.hashes = set()
+        self.lock = threading.Lock()
+
+    def add_new(self, hashes: List[bytes]) -> np.ndarray:
+        """
+        Adds the hashes not pending yet and returns a mask of those that were added. A mask rather than a
+        list, as pandas takes an empty list for a selection of no columns.
+        """
+        with self.lock:
+            added = np.array([chunk_hash not in self.hashes for chunk_hash in hashes], dtype=bool)
+            self.hashes.update(hashes)
+        return added
+
+    def remove(self, hashes: List[bytes]) -> None:
+        with self.lock:
+            self.hashes.difference_update(hashes)
+
+
+def has_token_ids(file_path: str, encoder: Encoder) -> bool:
+    """
+    Returns whether a Parquet file has the token ids of extract-wiki-2.0.py --pretokenize, made with the
+    tokenizer and maximum length of the encoder.
+    """
+    schema = pq.read_schema(file_path)
+    metadata = schema.metadata or {}
+    return (TOKEN_IDS_COLUMN in schema.names and metadata.get(b'tokenizer') == encoder.model_name.encode()
+            and metadata.get(b'max_seq_length') == str(encoder.max_seq_length).encode())
+
+
+def iter_row_group_batches(file_path: str, row_group: int, columns: List[str]):
+    """
+    Streams one row group of a Parquet file as pandas DataFrames of at most BATCH_ROWS chunks.
+    """
+    fragment = ds.ParquetFileFormat().make_fragment(
+        os.path.abspath(file_path), filesystem=pyarrow.fs.LocalFileSystem(), row_groups=[row_group])
+    for batch in fragment.to_batches(columns=columns, batch_size=BATCH_ROWS):
+        yield batch.to_pandas()
+
+
+def read_batches(row_groups: List[Tuple[str, int]], encoder: Encoder, metrics: PipelineMetrics):
+    """
+    Yields the batches of every row group, each row group followed by a Batch without df.
+    The token ids are read too if the file has them for this encoder.
+    """
+    file_columns = {}
+    for file_path, i in row_groups:
+        if file_path not in file_columns:
+            file_columns[file_path] = PARQUET_COLUMNS + ([TOKEN_IDS_COLUMN] if has_token_ids(file_path, encoder) else [])
+        batches = iter_row_group_batches(file_path, i, file_columns[file_path])
+        while True:
+            with metrics.stage('read') as counts:
+                df = next(batches, None)
+                if df is not None:
+                    counts['chunks'] = len(df)
+            if df is None:
+                break
+            yield Batch(file_path, i, df)
+        yield Batch(file_path, i, None)
+
+
+def dedup_batch(cursor, encoder: Encoder, pending: Optional[PendingHashes], sidecars: Optional[SidecarReader],
+                metrics: PipelineMetrics, batch: Batch) -> Batch:
+    """
+    Hashes the chunks of a batch, finds the distinct ones whose embedding is neither stored nor pending,
+    looks those up in the sidecar file of the row group, and tokenizes the ones that aren't there,
+    unless their token ids were read from the Parquet file.
+    Chunks with the same hash share one embedding. Without a cursor, every distinct chunk is new.
+    """
+    if batch.df is None:
+        return batch
+    df = batch.df
+    with metrics.stage('dedup', chunks=len(df)):
+        df['embedding_hash'] = [hash_chunk(chunk) for chunk in df['chunks']]
+        if NEAR_DUPLICATE_THRESHOLD is not None:
+            representatives = find_near_duplicates(df['chunks'].tolist(), NEAR_DUPLICATE_THRESHOLD)
+            df['embedding_hash'] = df['embedding_hash'].to_numpy()[representatives]
+        new_chunks = df.drop_duplicates('embedding_hash')
+
+        if cursor is not None:
+            # Find the chunks whose embedding is already stored, by this or an earlier load
+            cursor.execute(f"""
+               SELECT chunk_hash FROM {table_name}_embeddings WHERE chunk_hash = ANY(%s)
+            """, (new_chunks['embedding_hash'].tolist(),))
+            stored_hashes = {bytes(row[0]) for row in cursor.fetchall()}
+            new_chunks = new_chunks[~new_chunks['embedding_hash'].isin(stored_hashes)]
+        if pending is not None:
+            new_chunks = new_chunks[pending.add_new(new_chunks['embedding_hash'].tolist())]
+
+    in_sidecar = np.zeros(len(new_chunks), dtype=bool)
+    sidecar_embeddings = None
+    if sidecars is not None:
+        with metrics.stage('sidecar_read', chunks=len(new_chunks)):
+            in_sidecar, sidecar_embeddings = sidecars.lookup(batch.file_path, batch.row_group,
+                                                             new_chunks['embedding_hash'].tolist())
+
+    if TOKEN_IDS_COLUMN in new_chunks:
+        token_ids = new_chunks[TOKEN_IDS_COLUMN][~in_sidecar].tolist()
+    else:
+        chunks = new_chunks['chunks'][~in_sidecar].tolist()
+        with metrics.stage('tokenize', chunks=len(chunks)):
+            token_ids = encoder.tokenize(chunks) if chunks else []
+    return batch._replace(new_chunks=new_chunks, in_sidecar=in_sidecar, sidecar_embeddings=sidecar_embeddings,
+                          token_ids=token_ids)
+
+
+def encode_batch(encoder: Encoder, metrics: PipelineMetrics, batch: Batch) -> Batch:
+    """
+    Computes the embeddings of the new chunks of a batch that aren't in a sidecar file, in length-sorted
+    batches under the token budget set in encoders.py.
+    """
+    if batch.df is None:
+        return batch
+
+    # OPTION Use ADA-002 API for embeddings
+    # load_dotenv()
+    # openai.api_key = os.environ.get("OPENAI_API_KEY")
+    # response = openai.Embedding.create(
+    #     model="text-embedding-ada-002",
+    #     input=batch.new_chunks['chunks'].tolist()
+    # )
+    # embeddings = [item['embedding'] for item in response['data']]
+
+    embeddings = np.zeros((len(batch.new_chunks), encoder.dimension), dtype=np.float32)
+    if batch.in_sidecar.any():
+        embeddings[batch.in_sidecar] = batch.sidecar_embeddings
+    chunks = batch.new_chunks['chunks'][~batch.in_sidecar].tolist()
+    if chunks:
+        with metrics.stage('encode', chunks=len(chunks), bytes=sum(len(chunk) for chunk in chunks)):
+            embeddings[~batch.in_sidecar] = encoder.encode(chunks, token_ids=batch.token_ids)
+    return batch._replace(embeddings=embeddings)
+
+
+def insert_embeddings(cursor, batch: Batch, metrics: PipelineMetrics, load_method: str = LOAD_METHOD) -> None:
+    """
+    Adds the new embeddings of a batch to {table_name}_embeddings, skipping those another shard stored in
+    the meantime. They are inserted in hash order, so shards adding some of the same chunks lock them in
+    the same order and can't deadlock. Meant for an autocommit connection: every statement is then its
+    own short transaction, which is safe as an embedding only depends on its content hash.
+    """
+    hashes = batch.new_chunks['embedding_hash'].to_numpy()
+    order = np.argsort(hashes)
+    hashes, embeddings = hashes[order].tolist(), batch.embeddings[order]
+    with metrics.stage('db_insert_embeddings', chunks=len(hashes)):
+        if load_method == 'copy':
+            # Through the staging table, as COPY can't skip existing rows
+            copy_rows(cursor, f'{table_name}_embeddings_staging', ['chunk_hash', 'embedding'],
+                      [encode_bytea(hashes), encode_vector(embeddings)])
+            cursor.execute(f"""
+               INSERT INTO {table_name}_embeddings (chunk_hash, embedding)
+               SELECT chunk_hash, embedding FROM {table_name}_embeddings_staging
+               ORDER BY chunk_hash
+               ON CONFLICT (chunk_hash) DO NOTHING
+            """)
+            cursor.execute(f"TRUNCATE {table_name}_embeddings_staging")
+            return
+
+        psycopg2.extras.execute_values(
+            cursor,
+            f"""
+            INSERT INTO {table_name}_embeddings (chunk_hash, embedding) VALUES %s
+            ON CONFLICT (chunk_hash) DO NOTHING
+            """,
+            zip(hashes, embeddings),
+            template="(%s, %s::vector)"
+        )
+
+
+def insert_chunks(cursor, batch: Batch, metrics: PipelineMetrics, load_method: str = LOAD_METHOD) -> None:
+    """
+    Inserts the chunk rows of a batch.
+    """
+    df = batch.df
+    with metrics.stage('db_insert', chunks=len(df)):
+        if load_method == 'copy':
+            copy_rows(cursor, table_name, ['page_id', 'revision', 'title', 'chunk', 'embedding_hash'],
+                      [encode_int4(df['index'].to_numpy()), encode_int8(df['revision'].to_numpy()),
+                       encode_text(df['title']), encode_text(df['chunks']), encode_bytea(df['embedding_hash'])])
+            return
+
+        psycopg2.extras.execute_values(
+            cursor,
+            f"""
+            INSERT INTO {table_name} (page_id, revision, title, chunk, embedding_hash) VALUES %s
+            """,
+            zip(df['index'].tolist(), df['revision'].tolist(), df['title'], df['chunks'], df['embedding_hash']),
+            template="(%s, %s, %s, %s, %s)"
+        )
+
+
+def load_in_parallel(batches, num_connections: int, pending: PendingHashes, load_method: str,
+                     metrics: PipelineMetrics, progress: tqdm) -> None:
+    """
+    Inserts the batches over num_connections connections, each in its own thread, committing every batch
+    on its own. Row groups aren't committed as a whole, so no progress is recorded.
+    """
+    connections = [psycopg2.connect(**db_connection_params) for _ in range(num_connections)]
+    for connection in connections:
+        register_vector(connection)
+    work = queue.Queue(maxsize=num_connections)
+    errors = []
+
+    def _load(connection):
+        cursor = connection.cursor()
+        create_staging_table(cursor)
+        while True:
+            batch = work.get()
+            if batch is None:
+                break
+            # After an error, keep taking batches so the feeding thread isn't blocked
+            if errors:
+                continue
+            try:
+                # The pending hashes keep batches from sharing new embeddings, so the connections never wait
+                # on each other and both tables can be committed in one transaction
+                insert_embeddings(cursor, batch, metrics, load_method)
+                insert_chunks(cursor, batch, metrics, load_method)
+                with metrics.stage('db_commit'):
+                    connection.commit()
+                pending.remove(batch.new_chunks['embedding_hash'].tolist())
+                progress.update(len(batch.df))
+            except Exception as e:
+                errors.append(e)
+        cursor.close()
+
+    threads = [threading.Thread(target=_load, args=(connection,), name=f'load-{i}', daemon=True)
+               for i, connection in enumerate(connections)]
+    for thread in threads:
+        thread.start()
+    try:
+        for batch in batches:
+            if errors:
+                break
+            if batch.df is not None:
+                work.put(batch)
+    finally:
+        for _ in threads:
+            work.put(None)
+        for thread in threads:
+            thread.join()
+        for connection in connections:
+            connection.close()
+    if errors:
+        raise errors[0]
+
+
+def save_sidecars(batches, parquet_dir: str, encoder: Encoder, dtype: str, metrics: PipelineMetrics,
+                  complete: bool = False):
+    """
+    Passes the batches on a row group at a time, once the embeddings of its new chunks are saved to the
+    row group's sidecar file, so they aren't lost if inserting them fails. Nothing is written when they
+    were all read from the sidecar, or when it is from the same model and holds every distinct chunk of
+    the row group; complete marks a new one as such.
+    """
+    row_group_batches = []
+    for batch in batches:
+        row_group_batches.append(batch)
+        if batch.df is not None:
+            continue
+
+        # End of a row group
+        embeddings = {}
+        encoded = False
+        for row_group_batch in row_group_batches[:-1]:
+            embeddings.update(zip(row_group_batch.new_chunks['embedding_hash'], row_group_batch.embeddings))
+            encoded = encoded or not row_group_batch.in_sidecar.all()
+        path = get_sidecar_path(parquet_dir, batch.file_path, batch.row_group)
+        if (complete or encoded) and not is_sidecar_current(path, encoder.model_name, encoder.model_revision):
+            with metrics.stage('sidecar_write', chunks=len(embeddings)):
+                write_sidecar(path, encoder.model_name, encoder.model_revision, list(embeddings),
+                              np.array(list(embeddings.values()), dtype=np.float32).reshape(-1, encoder.dimension),
+                              dtype, complete)
+        yield from row_group_batches
+        row_group_batches = []
+
+
+def write_sidecars(args: argparse.Namespace, metrics: PipelineMetrics, metrics_path: str, metrics_labels: dict) -> None:
+    """
+    Encodes the distinct chunks of every row group into its sidecar file, without touching the database.
+    Row groups whose sidecar was written by the same model are skipped, so an interrupted run can be started again.
+    """
+    encoder = load_encoder(args.encoder, num_workers=args.encoder_workers)
+    row_groups = [(file_path, i) for file_path, i in select_shard(list_row_groups(args.parquet_dir), args.shard,
+                                                                  args.num_shards)
+                  if not is_sidecar_current(get_sidecar_path(args.parquet_dir, file_path, i), encoder.model_name,
+                                            encoder.model_revision)]
+    num_rows = sum(pq.ParquetFile(file_path).metadata.row_group(i).num_rows for file_path, i in row_groups)
+    print(f"{len(row_groups)} row groups, {num_rows} chunks to encode")
+
+    batches = iter_in_background(read_batches(row_groups, encoder, metrics), QUEUE_SIZE, 'read')
+    batches = iter_in_background(map(partial(dedup_batch, None, encoder, None, None, metrics), batches),
+                                 QUEUE_SIZE, 'dedup')
+    batches = iter_in_background(map(partial(encode_batch, encoder, metrics), batches), QUEUE_SIZE, 'encode')
+    batches = save_sidecars(batches, args.parquet_dir, encoder, args.sidecar_dtype, metrics, complete=True)
+
+    progress = tqdm(total=num_rows, desc="Encoding chunks", unit="chunk")
+    for batch in batches:
+        if batch.df is not None:
+            progress.update(len(batch.df))
+        else:
+            metrics.write(metrics_path, args.prometheus, **metrics_labels)
+    progress.close()
+    encoder.close()
+
+
+def main():
+    """
+    Streams the chunks of every row group of the Parquet files in --parquet-dir, encodes them and stores
+    them in PostgreSQL. Memory use is bounded by BATCH_ROWS, not by the size of the corpus.
+    Each row group is committed together with its row in {table_name}_progress, so --resume
+    skips exactly the row groups that are loaded, even after a crash.
+    The stages overlap: while one batch is inserted, the next is encoded and the one after is read,
+    so a run takes about as long as its slowest stage rather than the sum of them.
+    With --num-shards, each machine only loads the row groups its --shard owns.
+    With --bulk, a fresh load is inserted over several connections into UNLOGGED tables, see finish_bulk_load.
+    """
+    parser = argparse.ArgumentParser(description="Embed Wikipedia chunks and store them in PostgreSQL.")
+    parser.add_argument('--parquet-dir', metavar='DIR', default=parquet_path,
+                        help="directory of the Parquet files written by extract-wiki-2.0.py (default: %(default)s)")
+    parser.add_argument('--incremental', action='store_true',
+                        help="the Parquet files come from an extract-wiki-2.0.py --previous-run: keep the table, "
+                             "delete the rows of changed and deleted pages and insert the new chunks")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the row groups recorded as loaded by an interrupted run")
+    parser.add_argument('--encoder', choices=ENCODER_BACKENDS, default=ENCODER_BACKEND,
+                        help="sentence-transformers (GPU if available) or onnx (quantized model on the CPU); "
+                             "the model is set in encoders.py")
+    parser.add_argument('--encoder-workers', type=int, default=ENCODER_WORKERS, metavar='N',
+                        help="encode on the CPU with N model replicas in separate processes, "
+                             "see benchmark-encoders.py for the best number")
+    parser.add_argument('--load-method', choices=LOAD_METHODS, default=LOAD_METHOD,
+                        help="COPY in the binary format, or INSERT ... VALUES")
+    parser.add_argument('--bulk', action='store_true',
+                        help="fresh load over --load-connections connections into UNLOGGED tables, "
+                             "building the indexes once at the end; can't be resumed")
+    parser.add_argument('--load-connections', type=int, default=LOAD_CONNECTIONS, metavar='N',
+                        help="connections of a --bulk load")
+    parser.add_argument('--vector-index', choices=VECTOR_INDEX_METHODS, default=VECTOR_INDEX,
+                        help="ANN index built on the embeddings after the load; its settings are in vector_index.py")
+    parser.add_argument('--embeddings-only', action='store_true',
+                        help="only encode the chunks, into sidecar files in the " + SIDECAR_DIR_NAME
+                             + " subdirectory of --parquet-dir, without touching the database; later loads read "
+                               "them instead of encoding")
+    parser.add_argument('--sidecar-dtype', choices=['float16', 'float32'], default=SIDECAR_DTYPE,
+                        help="precision of the embeddings in the sidecar files")
+    parser.add_argument('--no-sidecars', action='store_true',
+                        help="don't save the embeddings encoded by a load to sidecar files")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="JSON lines file the per-stage metrics are appended to "
+                             "(default: metrics-embed.jsonl in the Parquet directory)")
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help="also write the metrics to this file in the Prometheus text format")
+    # Split the row groups across machines with --shard i --num-shards N
+    add_shard_arguments(parser)
+    args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    if args.bulk and (args.incremental or args.resume or args.num_shards > 1):
+        parser.error("--bulk is for a fresh, unsharded load, not with --incremental, --resume or --num-shards")
+    metrics_path = args.metrics or os.path.join(
+        args.parquet_dir, 'metrics-embed{}.jsonl'.format(get_shard_suffix(args.shard, args.num_shards)))
+    metrics_labels = {'pipeline': 'embed', 'shard': args.shard, 'num_shards': args.num_shards}
+
+    # Start the timer
+    start_time = time.time()
+
+    # Time and count the read, dedup, encode and DB insert stages
+    metrics = PipelineMetrics()
+
+    if args.embeddings_only:
+        write_sidecars(args, metrics, metrics_path, metrics_labels)
+        print(f"Script execution time: {time.time() - start_time} seconds")
+        metrics.print_summary()
+        return
+
+    # Initialize the encoder, the same one query_db.py uses. Its dimension is the one of the embedding column
+    encoder = load_encoder(args.encoder, num_workers=args.encoder_workers)
+
+    # Establish a connection to the database
+    db_connection = psycopg2.connect(**db_connection_params)
+
+    # Register the vector type with your connection
+    register_vector(db_connection)
+
+    # Create a cursor object
+    cursor = db_connection.cursor()
+
+    # Drop the tables, unless this is an incremental load, a resumed one, or other shards are loading
+    # into them at the same time
+    create_tables(cursor, drop=args.num_shards == 1 and not args.incremental and not args.resume,
+                  dimension=encoder.dimension, bulk=args.bulk)
+    db_connection.commit()
+
+    row_groups = select_shard(list_row_groups(args.parquet_dir), args.shard, args.num_shards)
+    progress_files = {file_path: get_progress_file(file_path) for file_path, _ in row_groups}
+    loaded = get_loaded_row_groups(cursor)
+    num_loaded = sum((progress_files[file_path], i) in loaded for file_path, i in row_groups)
+    if args.resume:
+        row_groups = [(file_path, i) for file_path, i in row_groups if (progress_files[file_path], i) not in loaded]
+    elif num_loaded:
+        # Their rows are in the shared tables, which only an unsharded, non-incremental run drops
+        raise SystemExit(f"{num_loaded} of the row groups are already loaded; run with --resume to load the others")
+    if args.incremental:
+        delete_changed_pages(cursor, args.parquet_dir)
+    db_connection.commit()
+
+    num_rows = sum(pq.ParquetFile(file_path).metadata.row_group(i).num_rows for file_path, i in row_groups)
+    print(f"{len(row_groups)} row groups, {num_rows} chunks to load")
+
+    # The dedup stage looks up stored embeddings on its own connection, as the main one is inside
+    # the transaction of the row group being inserted
+    lookup_connection = psycopg2.connect(**db_connection_params)
+    lookup_connection.autocommit = True
+    lookup_cursor = lookup_connection.cursor()
+    pending = PendingHashes()
+
+    # New embeddings are committed on their own, outside the transaction of the row group, so shards
+    # sharing chunks never hold locks on them for long, see insert_embeddings
+    embeddings_connection = psycopg2.connect(**db_connection_params)
+    embeddings_connection.autocommit = True
+    register_vector(embeddings_connection)
+    embeddings_cursor = embeddings_connection.cursor()
+    create_staging_table(embeddings_cursor)
+
+    # Read, dedup and tokenize, and encode in background threads, and insert in this one
+    batches = iter_in_background(read_batches(row_groups, encoder, metrics), QUEUE_SIZE, 'read')
+    sidecars = SidecarReader(args.parquet_dir, encoder.model_name, encoder.model_revision)
+    batches = iter_in_background(map(partial(dedup_batch, lookup_cursor, encoder, pending, sidecars, metrics),
+                                     batches), QUEUE_SIZE, 'dedup')
+    batches = iter_in_background(map(partial(encode_batch, encoder, metrics), batches), QUEUE_SIZE, 'encode')
+    if not args.no_sidecars:
+        # Each row group is held back until its embeddings are saved
+        batches = iter_in_background(save_sidecars(batches, args.parquet_dir, encoder, args.sidecar_dtype, metrics),
+                                     QUEUE_SIZE, 'sidecar')
+
+    progress = tqdm(total=num_rows, desc="Embedding chunks", unit="chunk")
+    if args.bulk:
+        load_in_parallel(batches, args.load_connections, pending, args.load_method, metrics, progress)
+        # Closed first, so the timings of the index builds aren't printed into the progress bar
+        progress.close()
+        finish_bulk_load(cursor, metrics)
+        db_connection.commit()
+    else:
+        rows = 0
+        for batch in batches:
+            if batch.df is not None:
+                insert_embeddings(embeddings_cursor, batch, metrics, args.load_method)
+                pending.remove(batch.new_chunks['embedding_hash'].tolist())
+                insert_chunks(cursor, batch, metrics, args.load_method)
+                rows += len(batch.df)
+                progress.update(len(batch.df))
+                continue
+
+            # End of a row group
+            cursor.execute(f"""
+               INSERT INTO {table_name}_progress (file, row_group, rows) VALUES (%s, %s, %s)
+            """, (progress_files[batch.file_path], batch.row_group, rows))
+            with metrics.stage('db_commit'):
+                db_connection.commit()
+            rows = 0
+            metrics.write(metrics_path, args.prometheus, **metrics_labels)
+    progress.close()
+    lookup_cursor.close()
+    lookup_connection.close()
+    embeddings_cursor.close()
+    embeddings_connection.close()
+
+    # Remove the embeddings no chunk points to anymore. Only safe when no other shard is loading
+    if args.incremental and args.num_shards == 1:
+        cursor.execute(f"""
+           DELETE FROM {table_name}_embeddings AS e
+           WHERE NOT EXISTS (SELECT 1 FROM {table_name} AS w WHERE w.embedding_hash = e.chunk_hash)
+        """)
+        print(f"Deleted {cursor.rowcount} unused embeddings")
+        db_connection.commit()
+
+    # With several shards, the others may still be loading; the index is built once they are all done
+    if args.num_shards == 1:
+        build_vector_index(cursor, args.vector_index, metrics)
+        db_connection.commit()
+    elif args.vector_index != 'none':
+        print("Run create-vector-index.py once every shard is loaded")
+
+    # Close the cursor and the connection, and stop the encoder's workers if it has any
+    encoder.close()
+    cursor.close()
+    db_connection.close()
+
+    # End the timer
+    end_time = time.time()
+    elapsed_time = end_time - start_time
+    print(f"Script execution time: {elapsed_time} seconds")
+    metrics.write(metrics_path, args.prometheus, **metrics_labels)
+    metrics.print_summary()
 
-# Set up connection parameters
-db_connection_params = {
-    "host": "localhost",
-    "database": "vector_db",
-    "user": os.environ["PG_VECTOR_DB_USER"],
-    "password": os.environ["PG_VECTOR_DB_PASSWORD"],
-}
 
-# Establish a connection to the database
-db_connection = psycopg2.connect(**db_connection_params)
-
-# Register the vector type with your connection
-register_vector(db_connection)
-
-# Create a cursor object
-cursor = db_connection.cursor()
-
-# Drop the table
-cursor.execute(f"""
-   DROP TABLE IF EXISTS {table_name}
-""")
-db_connection.commit()
-
-# Create the table
-cursor.execute(f"""
-   CREATE TABLE IF NOT EXISTS {table_name} (
-       id SERIAL PRIMARY KEY,
-       title TEXT NOT NULL,
-       chunk TEXT NOT NULL,
-       embedding VECTOR NOT NULL
-   )
-""")
-db_connection.commit()
-
-# Prepare data for insertion
-data_for_insertion = ((row.title, row.chunks, row.embedding)
-                      for _, row in df.iterrows())
-
-# Wrap your generator with tqdm for a progress bar
-data_for_insertion = tqdm(
-    data_for_insertion, desc="Uploading to database", total=df.shape[0])
-
-# Insert data into the table
-psycopg2.extras.execute_values(
-    cursor,
-    f"""
-    INSERT INTO {table_name} (title, chunk, embedding) VALUES %s
-    """,
-    data_for_insertion,
-    template="(%s, %s, %s::vector)"
-)
-db_connection.commit()
-
-# Close the cursor and the connection
-cursor.close()
-db_connection.close()
-
-# End the timer
-end_time = time.time()
-elapsed_time = end_time - start_time
-print(f"Script execution time: {elapsed_time} seconds")
+if __name__ == '__main__':
+    main()
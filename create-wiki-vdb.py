@@ -2,7 +2,9 @@ import os
 from pgvector.psycopg2 import register_vector
 import psycopg2.extras
 import psycopg2
-from sentence_transformers import SentenceTransformer
+from encoders import load_encoder
+from pg_copy import copy_rows, encode_bytea, encode_int4, encode_int8, encode_text, encode_vector
+from dedup import hash_chunk
 import pandas as pd
 import pyarrow.parquet as pq
 import mwparserfromhell
@@ -68,10 +70,10 @@ def split_text_into_chunks(text):
 
 def process_article(row):
     _, row_data = row
-    title, article = row_data.title, row_data.article
+    page_id, title, article = row_data['index'], row_data.title, row_data.article
     cleaned_article = clean_wiki_text(article)
     chunked_article = split_text_into_chunks(cleaned_article)
-    return pd.DataFrame([(title, chunk) for chunk in chunked_article], columns=['title', 'chunk'])
+    return pd.DataFrame([(page_id, title, chunk) for chunk in chunked_article], columns=['page_id', 'title', 'chunk'])
 
 
 with mp.Pool(processes=mp.cpu_count()) as pool:
@@ -80,22 +82,17 @@ with mp.Pool(processes=mp.cpu_count()) as pool:
 
 chunked_articles_df = pd.concat(chunked_articles_df_list, ignore_index=True)
 
-# Initialize the transformer model
-model = SentenceTransformer('multi-qa-MiniLM-L6-cos-v1', device='cuda')
-model.max_seq_length = 512
+# Initialize the encoder configured in encoders.py. This script has no __main__ block
+# for the processes of an encoder pool to skip, so it encodes in this process
+encoder = load_encoder(num_workers=1)
 
-# Define the batch size
-batch_size = 128
+# Chunks with the same text share one embedding, stored once in wikipedia_embeddings under the hash of
+# the normalized text, like create-wiki-vdb-2.0.py stores them (see setup.sql)
+chunked_articles_df['embedding_hash'] = [hash_chunk(chunk) for chunk in chunked_articles_df['chunk']]
+distinct_chunks = chunked_articles_df.drop_duplicates('embedding_hash').sort_values('embedding_hash')
 
-# Extract the chunks to a list
-chunks = chunked_articles_df['chunk'].tolist()
-
-# Compute embeddings for each chunk in the DataFrame
-embeddings = model.encode(chunks, batch_size=batch_size,
-                          convert_to_numpy=True, show_progress_bar=True)
-
-# Assign the embeddings back to the DataFrame
-chunked_articles_df['embedding'] = list(embeddings)
+# Compute embeddings for each distinct chunk, in length-sorted batches under the token budget
+embeddings = encoder.encode(distinct_chunks['chunk'].tolist(), show_progress_bar=True)
 
 # Set up connection parameters
 db_connection_params = {
@@ -114,40 +111,50 @@ register_vector(db_connection)
 # Create a cursor object
 cursor = db_connection.cursor()
 
-# # Drop test table
+# # Drop test tables
 # cursor.execute("""
-#     DROP TABLE IF EXISTS wikipedia
+#     DROP TABLE IF EXISTS wikipedia, wikipedia_embeddings
 # """)
 # db_connection.commit()
 #
-# # Create the table
+# # Create the tables of setup.sql, with the encoder's dimension so that an ANN index can be built on it
+# cursor.execute(f"""
+#     CREATE TABLE IF NOT EXISTS wikipedia_embeddings (
+#         chunk_hash BYTEA PRIMARY KEY,
+#         embedding VECTOR({encoder.dimension}) NOT NULL
+#     )
+# """)
 # cursor.execute("""
 #     CREATE TABLE IF NOT EXISTS wikipedia (
 #         id SERIAL PRIMARY KEY,
+#         page_id INTEGER NOT NULL,
+#         revision BIGINT NOT NULL,
 #         title TEXT NOT NULL,
 #         chunk TEXT NOT NULL,
-#         embedding VECTOR NOT NULL
+#         embedding_hash BYTEA NOT NULL
 #     )
 # """)
 # db_connection.commit()
 
-# Prepare data for insertion
-data_for_insertion = ((row.title, row.chunk, row.embedding)
-                      for _, row in chunked_articles_df.iterrows())
-
-# Wrap your generator with tqdm for a progress bar
-data_for_insertion = tqdm(
-    data_for_insertion, desc="Uploading to database", total=chunked_articles_df.shape[0])
-
-# Insert data into the table
-psycopg2.extras.execute_values(
-    cursor,
-    """
-    INSERT INTO wikipedia (title, chunk, embedding) VALUES %s
-    """,
-    data_for_insertion,
-    template="(%s, %s, %s::vector)"
-)
+# Load the rows with a binary COPY, the embeddings straight from the matrix in pgvector's binary format.
+# The embeddings go through a staging table, as COPY can't skip those an earlier load already stored
+cursor.execute("""
+    CREATE TEMPORARY TABLE wikipedia_embeddings_staging (LIKE wikipedia_embeddings INCLUDING DEFAULTS)
+""")
+copy_rows(cursor, 'wikipedia_embeddings_staging', ['chunk_hash', 'embedding'],
+          [encode_bytea(distinct_chunks['embedding_hash']), encode_vector(embeddings)])
+cursor.execute("""
+    INSERT INTO wikipedia_embeddings (chunk_hash, embedding)
+    SELECT chunk_hash, embedding FROM wikipedia_embeddings_staging
+    ORDER BY chunk_hash
+    ON CONFLICT (chunk_hash) DO NOTHING
+""")
+
+# extract-wiki.py doesn't record revisions, so the chunks get revision 0
+copy_rows(cursor, 'wikipedia', ['page_id', 'revision', 'title', 'chunk', 'embedding_hash'],
+          [encode_int4(chunked_articles_df['page_id'].to_numpy()), encode_int8([0] * len(chunked_articles_df)),
+           encode_text(chunked_articles_df['title']), encode_text(chunked_articles_df['chunk']),
+           encode_bytea(chunked_articles_df['embedding_hash'])])
 
 db_connection.commit()
 
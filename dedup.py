@@ -0,0 +1,85 @@
+import re
+import zlib
+import hashlib
+import unicodedata
+import numpy as np
+from typing import Dict, List, Sequence
+
+WHITESPACE_RE = re.compile(r'\s+')
+
+# Number of words in each shingle compared by MinHash
+SHINGLE_SIZE = 5
+
+# MinHash signature length, split into LSH bands of NUM_PERMUTATIONS // NUM_BANDS values
+NUM_PERMUTATIONS = 64
+NUM_BANDS = 16
+
+# Modulus of the MinHash permutations, whose results are then cut to 32 bits
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+
+
+def normalize_chunk(chunk: str) -> str:
+    """
+    Returns the form of a chunk that is hashed: Unicode NFKC, case-folded, with runs of whitespace collapsed.
+    Chunks that only differ in spacing or case map to the same embedding.
+    """
+    return WHITESPACE_RE.sub(' ', unicodedata.normalize('NFKC', chunk).casefold()).strip()
+
+
+def hash_chunk(chunk: str) -> bytes:
+    """
+    Returns the sha256 digest of a chunk's normalized text.
+    """
+    return hashlib.sha256(normalize_chunk(chunk).encode('utf-8')).digest()
+
+
+def _get_permutations(seed: int = 0):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, MERSENNE_PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+    b = rng.integers(0, MERSENNE_PRIME, size=NUM_PERMUTATIONS, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signature(chunk: str, permutations) -> np.ndarray:
+    """
+    Returns the MinHash signature of the word shingles of a chunk's normalized text.
+    """
+    words = normalize_chunk(chunk).split(' ')
+    shingles = {' '.join(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))}
+    hashes = np.fromiter((zlib.crc32(shingle.encode('utf-8')) for shingle in shingles),
+                         dtype=np.uint64, count=len(shingles))
+    a, b = permutations
+    # The products wrap around 2**64 on purpose; the low 32 bits are what spread the shingles evenly
+    return (((np.outer(hashes, a) + b) % MERSENNE_PRIME) & MAX_HASH).min(axis=0)
+
+
+def find_near_duplicates(chunks: Sequence[str], threshold: float = 0.9) -> List[int]:
+    """
+    Returns, for every chunk, the position of the chunk whose embedding it can reuse: itself, or an
+    earlier chunk whose estimated Jaccard similarity of word shingles is at least threshold.
+    Candidates are found with MinHash and locality-sensitive hashing, so this runs in linear time.
+    """
+    permutations = _get_permutations()
+    rows_per_band = NUM_PERMUTATIONS // NUM_BANDS
+    buckets: List[Dict[bytes, int]] = [{} for _ in range(NUM_BANDS)]
+    signatures: Dict[int, np.ndarray] = {}
+    representatives = []
+    for position, chunk in enumerate(chunks):
+        signature = minhash_signature(chunk, permutations)
+        band_keys = [signature[band * rows_per_band:(band + 1) * rows_per_band].tobytes()
+                     for band in range(NUM_BANDS)]
+
+        # Reuse the first candidate that is similar enough, and only index chunks that stay their own representative
+        representative = position
+        for band, key in enumerate(band_keys):
+            candidate = buckets[band].get(key)
+            if candidate is not None and np.mean(signatures[candidate] == signature) >= threshold:
+                representative = candidate
+                break
+        if representative == position:
+            signatures[position] = signature
+            for band, key in enumerate(band_keys):
+                buckets[band].setdefault(key, position)
+        representatives.append(representative)
+    return representatives
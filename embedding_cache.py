@@ -0,0 +1,108 @@
+import time
+import sqlite3
+import hashlib
+import numpy as np
+from typing import Dict, List
+
+# Number of keys looked up per query, under SQLite's limit on bound parameters
+LOOKUP_BATCH_SIZE = 500
+
+# Once the cache is over its size limit, the least recently used embeddings are evicted until it is
+# this fraction of the limit, so eviction doesn't run again after every insert
+EVICTION_TARGET = 0.9
+
+
+def get_text_hash(text: str) -> bytes:
+    return hashlib.sha256(text.encode('utf-8')).digest()
+
+
+class EmbeddingCache:
+    """
+    On-disk cache of embeddings in SQLite, keyed by (model name, model revision, sha256 of the text).
+    The revision identifies the exact weights and settings, so a new model version never reuses stale
+    vectors. Every lookup refreshes the entries it hits, and when the database holds more than max_bytes
+    of live pages, the least recently used entries are deleted.
+    """
+
+    def __init__(self, path: str, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        # Used by one thread at a time, but not always the one that opened it
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                revision TEXT NOT NULL,
+                text_hash BLOB NOT NULL,
+                embedding BLOB NOT NULL,
+                last_used REAL NOT NULL,
+                UNIQUE (model, revision, text_hash)
+            )
+        """)
+        self.connection.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used_idx ON embeddings (last_used)")
+        self.connection.commit()
+
+    def get_many(self, model: str, revision: str, text_hashes: List[bytes]) -> Dict[bytes, np.ndarray]:
+        """
+        Returns the cached embeddings of the given text hashes, leaving out the ones not in the cache.
+        """
+        found = {}
+        now = time.time()
+        for i in range(0, len(text_hashes), LOOKUP_BATCH_SIZE):
+            batch = text_hashes[i:i + LOOKUP_BATCH_SIZE]
+            placeholders = ','.join('?' * len(batch))
+            rows = self.connection.execute(f"""
+                SELECT text_hash, embedding FROM embeddings
+                WHERE model = ? AND revision = ? AND text_hash IN ({placeholders})
+            """, [model, revision, *batch]).fetchall()
+            for text_hash, embedding in rows:
+                found[bytes(text_hash)] = np.frombuffer(embedding, dtype=np.float32)
+            self.connection.execute(f"""
+                UPDATE embeddings SET last_used = ?
+                WHERE model = ? AND revision = ? AND text_hash IN ({placeholders})
+            """, [now, model, revision, *batch])
+        self.connection.commit()
+        return found
+
+    def put_many(self, model: str, revision: str, text_hashes: List[bytes], embeddings: np.ndarray) -> None:
+        now = time.time()
+        self.connection.executemany("""
+            INSERT OR REPLACE INTO embeddings (model, revision, text_hash, embedding, last_used)
+            VALUES (?, ?, ?, ?, ?)
+        """, ((model, revision, text_hash, embedding.astype(np.float32).tobytes(), now)
+              for text_hash, embedding in zip(text_hashes, embeddings)))
+        self.connection.commit()
+        self.evict()
+
+    def get_size(self) -> int:
+        """
+        Returns the bytes of the database's pages in use. Pages freed by eviction are reused by
+        later inserts, so the file itself stops growing once it reaches max_bytes.
+        """
+        page_size = self.connection.execute("PRAGMA page_size").fetchone()[0]
+        page_count = self.connection.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = self.connection.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used entries so the cache gets back to about EVICTION_TARGET of max_bytes.
+        Deleting rows doesn't free their pages one for one, so the size is measured again on the next insert
+        rather than in a loop here.
+        """
+        size = self.get_size()
+        if size <= self.max_bytes:
+            return
+        num_rows = self.connection.execute("SELECT count(*) FROM embeddings").fetchone()[0]
+        excess_rows = int(num_rows * (1 - self.max_bytes * EVICTION_TARGET / size)) + 1
+        self.connection.execute("""
+            DELETE FROM embeddings WHERE rowid IN (
+                SELECT rowid FROM embeddings ORDER BY last_used LIMIT ?
+            )
+        """, (excess_rows,))
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
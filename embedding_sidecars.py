@@ -0,0 +1,117 @@
+import os
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Dict, List, Tuple
+
+# Sidecar files live in this subdirectory of the Parquet directory, one pair per row group of the text files
+SIDECAR_DIR_NAME = 'embeddings'
+
+# float16 halves the size of the files, and the cosine similarity of the embeddings to their float32
+# originals stays above 0.9999
+SIDECAR_DTYPE = 'float16'
+
+
+def get_sidecar_path(parquet_dir: str, file_path: str, row_group: int) -> str:
+    """
+    Returns the path of the sidecar file holding the chunk hashes of one row group of a text Parquet file.
+    Their embeddings are in the .npy file of the same name, see get_embeddings_path.
+    """
+    stem = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(parquet_dir, SIDECAR_DIR_NAME, f'{stem}-rg{row_group:05d}.parquet')
+
+
+def get_embeddings_path(path: str) -> str:
+    return os.path.splitext(path)[0] + '.npy'
+
+
+def write_sidecar(path: str, model_name: str, model_revision: str, chunk_hashes: List[bytes],
+                  embeddings: np.ndarray, dtype: str = SIDECAR_DTYPE, complete: bool = True) -> None:
+    """
+    Writes the embeddings of the distinct chunks of a row group as a .npy matrix, and their hashes, keyed like
+    {table_name}_embeddings, in the same order as a Parquet file. The model that encoded them, and whether
+    they are all the distinct chunks of the row group, are recorded in the Parquet file's metadata.
+    Both are written under a temporary name and renamed once complete, the Parquet file last.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    embeddings_path = get_embeddings_path(path)
+    tmp_path = embeddings_path + '.tmp'
+    # np.save pads the header to 64 bytes, so the memory-mapped matrix is aligned
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(embeddings, dtype=dtype))
+    os.replace(tmp_path, embeddings_path)
+
+    table = pa.table({'chunk_hash': pa.array(chunk_hashes, pa.binary(32))})
+    table = table.replace_schema_metadata({'model': model_name, 'revision': model_revision,
+                                           'complete': 'true' if complete else 'false'})
+    tmp_path = path + '.tmp'
+    pq.write_table(table, tmp_path, compression='none', use_dictionary=False)
+    os.replace(tmp_path, path)
+
+
+def is_sidecar_current(path: str, model_name: str, model_revision: str) -> bool:
+    """
+    Returns whether the sidecar file exists, holds every distinct chunk of its row group, and was written
+    by the given model and revision.
+    """
+    if not os.path.isfile(path):
+        return False
+    metadata = pq.read_schema(path).metadata or {}
+    return metadata.get(b'model') == model_name.encode() and metadata.get(b'revision') == model_revision.encode() \
+        and metadata.get(b'complete') == b'true'
+
+
+def read_sidecar(path: str) -> Tuple[Dict[str, str], List[bytes], np.ndarray]:
+    """
+    Returns the metadata, the chunk hashes and the embeddings matrix of a sidecar file.
+    The matrix is memory-mapped from the .npy file, so rows are only read from disk when used.
+    """
+    table = pq.read_table(path)
+    metadata = {key.decode(): value.decode() for key, value in (table.schema.metadata or {}).items()}
+    embeddings = np.load(get_embeddings_path(path), mmap_mode='r')
+    if len(embeddings) != table.num_rows:
+        raise ValueError(f"{path} has {table.num_rows} chunk hashes but {len(embeddings)} embeddings")
+    return metadata, table.column('chunk_hash').to_pylist(), embeddings
+
+
+class SidecarReader:
+    """
+    Looks up embeddings in the sidecar files of a Parquet directory written by the encoder of the
+    given model and revision. Files of another model or revision are ignored. Row groups are
+    expected in order, so only the sidecar of the current one is kept open.
+    """
+
+    def __init__(self, parquet_dir: str, model_name: str, model_revision: str):
+        self.parquet_dir = parquet_dir
+        self.model_name = model_name
+        self.model_revision = model_revision
+        self.key = None
+        self.positions = {}
+        self.embeddings = None
+
+    def _open(self, file_path: str, row_group: int) -> None:
+        self.key = (file_path, row_group)
+        self.positions = {}
+        self.embeddings = None
+        path = get_sidecar_path(self.parquet_dir, file_path, row_group)
+        if not os.path.isfile(path):
+            return
+        metadata, chunk_hashes, embeddings = read_sidecar(path)
+        if metadata.get('model') != self.model_name or metadata.get('revision') != self.model_revision:
+            print(f"Ignoring {path}, encoded by {metadata.get('model')} {metadata.get('revision')}")
+            return
+        self.positions = {chunk_hash: i for i, chunk_hash in enumerate(chunk_hashes)}
+        self.embeddings = embeddings
+
+    def lookup(self, file_path: str, row_group: int, chunk_hashes: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns which of the chunk hashes are in the sidecar of the row group, and the float32 embeddings
+        of those that are, in order.
+        """
+        if self.key != (file_path, row_group):
+            self._open(file_path, row_group)
+        rows = np.array([self.positions.get(chunk_hash, -1) for chunk_hash in chunk_hashes], dtype=np.int64)
+        found = rows >= 0
+        if self.embeddings is None:
+            return found, np.zeros((0, 0), dtype=np.float32)
+        return found, self.embeddings[rows[found]].astype(np.float32)
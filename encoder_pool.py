@@ -0,0 +1,139 @@
+import os
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+from tqdm import tqdm
+from typing import List, Optional
+from encoders import (Encoder, SentenceTransformerEncoder, OnnxEncoder, load_tokenizer, tokenize_texts,
+                      make_token_budget_batches, ENCODER_MODEL, ENCODER_MODEL_REVISION, MAX_SEQ_LENGTH,
+                      MAX_BATCH_TOKENS, MAX_BATCH_SIZE)
+
+# Encoder of the worker process, loaded by _init_worker
+_encoder = None
+# Shared output matrix the worker is attached to: (name, SharedMemory, array)
+_output = None
+
+
+def _init_worker(backend: str, model_name: str, num_threads: int) -> None:
+    """
+    Loads the model replica of a worker process, limited to num_threads threads.
+    """
+    global _encoder
+    # Read by the OpenMP and MKL runtimes when torch or onnxruntime load them
+    os.environ['OMP_NUM_THREADS'] = str(num_threads)
+    os.environ['MKL_NUM_THREADS'] = str(num_threads)
+    if backend == 'onnx':
+        _encoder = OnnxEncoder(model_name, num_threads=num_threads)
+    else:
+        import torch
+        torch.set_num_threads(num_threads)
+        torch.set_num_interop_threads(1)
+        _encoder = SentenceTransformerEncoder(model_name, device='cpu')
+
+
+def _describe_worker():
+    return _encoder.model_revision, _encoder.dimension
+
+
+def _get_output(name: str, shape: tuple, dtype: str) -> np.ndarray:
+    """
+    Returns the shared output matrix called name, attaching to it on first use. The pool replaces
+    the matrix when it needs a larger one, and the worker then lets go of the old one.
+    """
+    global _output
+    if _output is None or _output[0] != name:
+        if _output is not None:
+            _output[1].close()
+        memory = shared_memory.SharedMemory(name=name)
+        _output = (name, memory, np.ndarray(shape, dtype=dtype, buffer=memory.buf))
+    return _output[2]
+
+
+def _encode_task(task) -> int:
+    """
+    Encodes one batch and writes its embeddings into the rows of the shared output matrix given by positions.
+    Only the number of rows is sent back.
+    """
+    name, shape, dtype, positions, texts, token_ids = task
+    output = _get_output(name, shape, dtype)
+    output[positions] = _encoder.encode_batch(texts, token_ids)
+    return len(positions)
+
+
+class EncoderPool(Encoder):
+    """
+    Encodes on the CPU with num_workers replicas of the model in separate processes, each using
+    threads_per_worker threads. One process can't keep a many-core machine busy, as much of the
+    work between matrix multiplications is single-threaded. The parent tokenizes the texts and makes the
+    token-budget batches; the workers write the embeddings straight into a matrix in shared memory,
+    so no embeddings are pickled between processes.
+    """
+
+    def __init__(self, backend: str, model_name: str = ENCODER_MODEL, num_workers: int = 2,
+                 threads_per_worker: Optional[int] = None, dtype: str = 'float32',
+                 max_seq_length: int = MAX_SEQ_LENGTH):
+        if threads_per_worker is None:
+            threads_per_worker = max((os.cpu_count() or 1) // num_workers, 1)
+        self.model_name = model_name
+        self.num_workers = num_workers
+        self.threads_per_worker = threads_per_worker
+        self.dtype = np.dtype(dtype)
+        self.max_seq_length = max_seq_length
+        self.tokenizer = load_tokenizer(model_name, ENCODER_MODEL_REVISION if backend == 'sentence-transformers' else None)
+        # Spawned rather than forked, as torch and ONNX Runtime don't survive a fork once their threads are started
+        self.pool = multiprocessing.get_context('spawn').Pool(
+            num_workers, initializer=_init_worker, initargs=(backend, model_name, threads_per_worker))
+        self.model_revision, self.dimension = self.pool.apply(_describe_worker)
+        self.output = None
+        self.capacity = 0
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        return tokenize_texts(self.tokenizer, texts, self.max_seq_length)
+
+    def _reserve(self, num_rows: int) -> None:
+        """
+        Makes sure the shared output matrix has room for num_rows rows, replacing it with one twice as large if not.
+        """
+        if num_rows <= self.capacity:
+            return
+        capacity = max(num_rows, 2 * self.capacity)
+        self._release()
+        self.capacity = capacity
+        self.output = shared_memory.SharedMemory(create=True, size=self.capacity * self.dimension * self.dtype.itemsize)
+
+    def _release(self) -> None:
+        if self.output is not None:
+            self.output.close()
+            self.output.unlink()
+            self.output = None
+            self.capacity = 0
+
+    def encode(self, texts: List[str], max_batch_tokens: Optional[int] = MAX_BATCH_TOKENS,
+               max_batch_size: int = MAX_BATCH_SIZE, show_progress_bar: bool = False,
+               token_ids: Optional[List[List[int]]] = None) -> np.ndarray:
+        """
+        Encodes the texts in length-sorted batches spread over the workers, and returns the embeddings
+        in the original order, in the pool's dtype.
+        """
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=self.dtype)
+        if token_ids is None:
+            token_ids = self.tokenize(texts)
+        lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+        self._reserve(len(texts))
+        shape = (self.capacity, self.dimension)
+        tasks = ((self.output.name, shape, self.dtype.str, batch, [texts[i] for i in batch],
+                  [token_ids[i] for i in batch])
+                 for batch in make_token_budget_batches(lengths, max_batch_tokens, max_batch_size))
+        progress = tqdm(total=len(texts), desc="Encoding", disable=not show_progress_bar)
+        for num_rows in self.pool.imap_unordered(_encode_task, tasks):
+            progress.update(num_rows)
+        progress.close()
+        # Copied out, as the next call writes over the shared matrix
+        output = np.ndarray(shape, dtype=self.dtype, buffer=self.output.buf)
+        return output[:len(texts)].copy()
+
+    def close(self) -> None:
+        self.pool.close()
+        self.pool.join()
+        self._release()
@@ -0,0 +1,301 @@
+import os
+import copy
+import hashlib
+import numpy as np
+from tqdm import tqdm
+from typing import List, Optional
+from embedding_cache import EmbeddingCache, get_text_hash
+
+# Encoder used by the embedding scripts and query_db.py, so chunks and queries are always encoded the same way.
+# Every setting can be overridden with the environment variable of the same name, e.g. ENCODER_BACKEND=onnx
+ENCODER_BACKEND = os.environ.get('ENCODER_BACKEND', 'sentence-transformers')  # or 'onnx'
+ENCODER_MODEL = os.environ.get('ENCODER_MODEL', 'sentence-transformers/multi-qa-MiniLM-L6-cos-v1')
+# Hugging Face revision (branch, tag or commit) of the model; pin it so cached embeddings stay valid
+ENCODER_MODEL_REVISION = os.environ.get('ENCODER_MODEL_REVISION')
+# 'cuda' or 'cpu'; by default cuda when torch can see a GPU
+ENCODER_DEVICE = os.environ.get('ENCODER_DEVICE')
+MAX_SEQ_LENGTH = int(os.environ.get('MAX_SEQ_LENGTH', 512))
+
+# Quantized (int8) model written by convert-to-onnx.py, which outputs the mean-pooled token embeddings
+ONNX_MODEL_PATH = os.environ.get('ONNX_MODEL_PATH', 'embeddings.onnx')
+# Threads ONNX Runtime uses within one operator (matrix multiplications); one per physical core works best
+ONNX_THREADS = int(os.environ.get('ONNX_THREADS', os.cpu_count() or 1))
+# multi-qa-MiniLM-L6-cos-v1 is trained for cosine similarity, and sentence-transformers normalizes its output
+ONNX_NORMALIZE = os.environ.get('ONNX_NORMALIZE', '1') == '1'
+
+# Chunks are sorted by token length and batched under a budget of padded tokens (batch size x longest
+# chunk in the batch) rather than a fixed count, so short chunks aren't padded to the length of long ones
+MAX_BATCH_TOKENS = int(os.environ.get('MAX_BATCH_TOKENS', 16384))
+MAX_BATCH_SIZE = int(os.environ.get('MAX_BATCH_SIZE', 256))
+
+# Embeddings are cached on disk, keyed by model, revision and text, so reruns only encode new text.
+# Set EMBEDDING_CACHE_PATH to an empty string to disable the cache
+EMBEDDING_CACHE_PATH = os.environ.get('EMBEDDING_CACHE_PATH', 'embedding_cache.sqlite')
+EMBEDDING_CACHE_MAX_BYTES = int(os.environ.get('EMBEDDING_CACHE_MAX_BYTES', 50 * 1024 ** 3))
+
+# On the CPU, encode with this many model replicas in separate processes (see encoder_pool.py), each using
+# ENCODER_THREADS_PER_WORKER threads (by default the cores divided among them). They write the embeddings
+# into a shared matrix of ENCODER_POOL_DTYPE, float32 or float16. 1 encodes in this process
+ENCODER_WORKERS = int(os.environ.get('ENCODER_WORKERS', 1))
+ENCODER_THREADS_PER_WORKER = int(os.environ['ENCODER_THREADS_PER_WORKER']) \
+    if 'ENCODER_THREADS_PER_WORKER' in os.environ else None
+ENCODER_POOL_DTYPE = os.environ.get('ENCODER_POOL_DTYPE', 'float32')
+
+ENCODER_BACKENDS = ('sentence-transformers', 'onnx')
+
+
+def load_tokenizer(model_name: str = ENCODER_MODEL, revision: Optional[str] = ENCODER_MODEL_REVISION):
+    """
+    Returns the Hugging Face fast tokenizer of the model, the one every backend feeds its token ids from.
+    """
+    from transformers import AutoTokenizer
+    if revision:
+        return AutoTokenizer.from_pretrained(model_name, revision=revision, use_fast=True)
+    return AutoTokenizer.from_pretrained(model_name, use_fast=True)
+
+
+def get_model_commit(model, model_name: str, revision: Optional[str]) -> Optional[str]:
+    """
+    Returns the Hugging Face commit the weights of a SentenceTransformer were loaded from, or None for
+    a local model. Older transformers record it in the config, newer ones only in the local Hub cache,
+    where loading the model just resolved the revision.
+    """
+    commit_hash = getattr(model[0].auto_model.config, '_commit_hash', None)
+    if commit_hash is not None or os.path.isdir(model_name):
+        return commit_hash
+    from huggingface_hub import snapshot_download
+    try:
+        return os.path.basename(snapshot_download(model_name, revision=revision, local_files_only=True))
+    except Exception:
+        return None
+
+
+def tokenize_texts(tokenizer, texts: List[str], max_seq_length: int = MAX_SEQ_LENGTH) -> List[List[int]]:
+    """
+    Returns the token ids of the texts, with the special tokens and truncated to max_seq_length,
+    as the model sees them. Also used by extract-wiki-2.0.py --pretokenize.
+    """
+    if not texts:
+        return []
+    return tokenizer(texts, truncation=True, max_length=max_seq_length)['input_ids']
+
+
+def pad_token_ids(token_ids: List[List[int]], pad_token_id: int):
+    """
+    Returns the token ids of a batch padded to its longest text, and the attention mask, as int64 matrices.
+    """
+    longest = max(len(ids) for ids in token_ids)
+    input_ids = np.full((len(token_ids), longest), pad_token_id, dtype=np.int64)
+    attention_mask = np.zeros((len(token_ids), longest), dtype=np.int64)
+    for row, ids in enumerate(token_ids):
+        input_ids[row, :len(ids)] = ids
+        attention_mask[row, :len(ids)] = 1
+    return input_ids, attention_mask
+
+
+def make_token_budget_batches(lengths: np.ndarray, max_batch_tokens: Optional[int],
+                              max_batch_size: int = MAX_BATCH_SIZE) -> List[np.ndarray]:
+    """
+    Returns batches of positions into lengths. Positions are sorted by length, longest first, and each batch
+    takes as many as fit in max_batch_tokens once padded to its first (longest) one, up to max_batch_size.
+    With max_batch_tokens None, returns batches of max_batch_size positions in their original order.
+    """
+    if max_batch_tokens is None:
+        return [np.arange(i, min(i + max_batch_size, len(lengths))) for i in range(0, len(lengths), max_batch_size)]
+    order = np.argsort(-np.asarray(lengths), kind='stable')
+    batches = []
+    start = 0
+    while start < len(order):
+        longest = max(int(lengths[order[start]]), 1)
+        size = min(max(max_batch_tokens // longest, 1), max_batch_size)
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+
+class Encoder:
+    """
+    Turns a list of texts into a float32 matrix with one row per text, in the order of the texts.
+    Subclasses tokenize the texts and encode one batch of them; the batching is done here.
+    """
+    model_name: str
+    # Identifies the weights and the settings that change the output, for the embedding cache
+    model_revision: str
+    dimension: int
+    # Texts are truncated to this many tokens, special tokens included
+    max_seq_length: int
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        raise NotImplementedError
+
+    def encode_batch(self, texts: List[str], token_ids: List[List[int]]) -> np.ndarray:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+    def encode(self, texts: List[str], max_batch_tokens: Optional[int] = MAX_BATCH_TOKENS,
+               max_batch_size: int = MAX_BATCH_SIZE, show_progress_bar: bool = False,
+               token_ids: Optional[List[List[int]]] = None) -> np.ndarray:
+        """
+        Encodes the texts in length-sorted batches under a token budget, see make_token_budget_batches,
+        and returns the embeddings in the original order. The texts are tokenized here unless their
+        token_ids, from tokenize, are given.
+        """
+        if token_ids is None:
+            token_ids = self.tokenize(texts)
+        lengths = np.array([len(ids) for ids in token_ids], dtype=np.int64)
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for batch in tqdm(make_token_budget_batches(lengths, max_batch_tokens, max_batch_size),
+                          desc="Encoding", disable=not show_progress_bar):
+            embeddings[batch] = self.encode_batch([texts[i] for i in batch], [token_ids[i] for i in batch])
+        return embeddings
+
+
+class SentenceTransformerEncoder(Encoder):
+    """
+    The reference encoder: the sentence-transformers model on the GPU if there is one, else on the CPU.
+    Batches are fed to the model as padded token ids, so texts aren't tokenized again.
+    """
+
+    def __init__(self, model_name: str = ENCODER_MODEL, device: Optional[str] = ENCODER_DEVICE,
+                 max_seq_length: int = MAX_SEQ_LENGTH, revision: Optional[str] = ENCODER_MODEL_REVISION):
+        from sentence_transformers import SentenceTransformer
+        if device is None:
+            import torch
+            device = 'cuda' if torch.cuda.is_available() else 'cpu'
+        self.model_name = model_name
+        self.model = (SentenceTransformer(model_name, device=device, revision=revision) if revision
+                      else SentenceTransformer(model_name, device=device))
+        # The commit the weights were loaded from, so a new revision on the Hub isn't mistaken for the cached one
+        commit_hash = get_model_commit(self.model, model_name, revision)
+        self.model_revision = f"{commit_hash or revision or 'unpinned'}-len{max_seq_length}"
+        self.model.max_seq_length = max_seq_length
+        self.max_seq_length = max_seq_length
+        self.dimension = self.model.get_sentence_embedding_dimension()
+        # A copy, as a fast tokenizer can't be used by two threads at once, and tokenize may run in
+        # another thread than encode_batch
+        self.tokenizer = copy.deepcopy(self.model.tokenizer)
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        return tokenize_texts(self.tokenizer, texts, self.max_seq_length)
+
+    def encode_batch(self, texts: List[str], token_ids: List[List[int]]) -> np.ndarray:
+        import torch
+        input_ids, attention_mask = pad_token_ids(token_ids, self.tokenizer.pad_token_id)
+        features = {'input_ids': torch.from_numpy(input_ids).to(self.model.device),
+                    'attention_mask': torch.from_numpy(attention_mask).to(self.model.device)}
+        if 'token_type_ids' in self.tokenizer.model_input_names:
+            features['token_type_ids'] = torch.zeros_like(features['input_ids'])
+        # Runs every module of the model (transformer, pooling and normalization), like SentenceTransformer.encode
+        with torch.inference_mode():
+            embeddings = self.model(features)['sentence_embedding']
+        return embeddings.float().cpu().numpy()
+
+
+class OnnxEncoder(Encoder):
+    """
+    CPU encoder running the quantized ONNX export of the model with ONNX Runtime. The tokenizer is
+    the model's Hugging Face fast tokenizer. Texts are tokenized once, and each batch is padded to its longest text.
+    """
+
+    def __init__(self, model_name: str = ENCODER_MODEL, model_path: str = ONNX_MODEL_PATH,
+                 num_threads: int = ONNX_THREADS, normalize: bool = ONNX_NORMALIZE,
+                 max_seq_length: int = MAX_SEQ_LENGTH):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = onnxruntime.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.tokenizer = load_tokenizer(model_name, revision=None)
+        self.model_name = model_name
+        self.normalize = normalize
+        self.max_seq_length = max_seq_length
+        model_digest = hashlib.sha256()
+        with open(model_path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                model_digest.update(block)
+        self.model_revision = f"onnx-{model_digest.hexdigest()[:16]}-len{max_seq_length}{'-normalized' if normalize else ''}"
+        self.dimension = self.session.get_outputs()[0].shape[-1]
+        if not isinstance(self.dimension, int):
+            # The export left the dimension symbolic
+            self.dimension = self.encode_batch(['dimension'], self.tokenize(['dimension'])).shape[1]
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        return tokenize_texts(self.tokenizer, texts, self.max_seq_length)
+
+    def encode_batch(self, texts: List[str], token_ids: List[List[int]]) -> np.ndarray:
+        input_ids, attention_mask = pad_token_ids(token_ids, self.tokenizer.pad_token_id)
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask,
+                  'token_type_ids': np.zeros_like(input_ids)}
+        embeddings = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+        embeddings = embeddings.astype(np.float32, copy=False)
+        if self.normalize:
+            embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+        return embeddings
+
+
+class CachedEncoder(Encoder):
+    """
+    Wraps an encoder with an EmbeddingCache: texts whose embedding is cached are not encoded again,
+    and the embeddings of the others are added to the cache.
+    """
+
+    def __init__(self, encoder: Encoder, cache: EmbeddingCache):
+        self.encoder = encoder
+        self.cache = cache
+        self.model_name = encoder.model_name
+        self.model_revision = encoder.model_revision
+        self.dimension = encoder.dimension
+        self.max_seq_length = encoder.max_seq_length
+
+    def tokenize(self, texts: List[str]) -> List[List[int]]:
+        return self.encoder.tokenize(texts)
+
+    def encode(self, texts: List[str], max_batch_tokens: Optional[int] = MAX_BATCH_TOKENS,
+               max_batch_size: int = MAX_BATCH_SIZE, show_progress_bar: bool = False,
+               token_ids: Optional[List[List[int]]] = None) -> np.ndarray:
+        text_hashes = [get_text_hash(text) for text in texts]
+        cached = self.cache.get_many(self.model_name, self.model_revision, text_hashes)
+        missing = [i for i, text_hash in enumerate(text_hashes) if text_hash not in cached]
+        embeddings = np.zeros((len(texts), self.dimension), dtype=np.float32)
+        for i, text_hash in enumerate(text_hashes):
+            if text_hash in cached:
+                embeddings[i] = cached[text_hash]
+        if missing:
+            new_embeddings = self.encoder.encode(
+                [texts[i] for i in missing], max_batch_tokens=max_batch_tokens, max_batch_size=max_batch_size,
+                show_progress_bar=show_progress_bar,
+                token_ids=None if token_ids is None else [token_ids[i] for i in missing])
+            embeddings[missing] = new_embeddings
+            self.cache.put_many(self.model_name, self.model_revision, [text_hashes[i] for i in missing],
+                                new_embeddings)
+        return embeddings
+
+    def close(self) -> None:
+        self.encoder.close()
+        self.cache.close()
+
+
+def load_encoder(backend: str = ENCODER_BACKEND, model_name: str = ENCODER_MODEL,
+                 cache_path: Optional[str] = EMBEDDING_CACHE_PATH, num_workers: int = ENCODER_WORKERS) -> Encoder:
+    """
+    Returns the encoder of the given backend, 'sentence-transformers' or 'onnx', behind the embedding
+    cache at cache_path unless it is None or empty. With num_workers above 1, returns an EncoderPool
+    of that many CPU replicas; the calling script must then start from an `if __name__ == '__main__'` block.
+    """
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Unknown encoder backend {backend!r}, expected one of {', '.join(ENCODER_BACKENDS)}")
+    if num_workers > 1:
+        from encoder_pool import EncoderPool
+        encoder = EncoderPool(backend, model_name, num_workers, ENCODER_THREADS_PER_WORKER, ENCODER_POOL_DTYPE)
+    elif backend == 'sentence-transformers':
+        encoder = SentenceTransformerEncoder(model_name)
+    else:
+        encoder = OnnxEncoder(model_name)
+    if cache_path:
+        encoder = CachedEncoder(encoder, EmbeddingCache(cache_path, EMBEDDING_CACHE_MAX_BYTES))
+    return encoder
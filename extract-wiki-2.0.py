@@ -1,221 +1,562 @@
 import os
-import io
-import bz2
-import pandas as pd
-import numpy as np
+import argparse
 import pyarrow.parquet as pq
 import pyarrow as pa
-import lxml.etree as etree
+import pyarrow.compute as pc
+import numpy as np
 from multiprocessing import Pool
 from tqdm import tqdm
-from bz2 import BZ2Decompressor
-from typing import List, Generator
-import mwparserfromhell
+from typing import Dict, List, Generator, Optional, Set, Tuple
 import traceback
+import threading
+import time
+from wiki_dump import DumpPart, find_dump_parts, load_offset_index, get_stream_ranges, open_dump, read_stream, decompress_stream, parse_pages
+from manifest import load_manifest, append_manifest, reset_manifest
+from parquet_sink import (ParquetShardWriter, PARQUET_SCHEMA, PARQUET_COMPRESSION, PARQUET_COMPRESSION_LEVEL,
+                          TARGET_SHARD_BYTES, ROW_GROUP_SIZE)
+from wiki_text import clean_wiki_text, split_text_into_chunks
+from sharding import add_shard_arguments, check_shard_arguments, select_shard, get_shard_suffix
+from metrics import PipelineMetrics
+from encoders import ENCODER_MODEL, MAX_SEQ_LENGTH, load_tokenizer, tokenize_texts
 
 # Wikipedia dump version
 DUMP_VERSION = '20230301'
 
-# File paths for input and output files
-ARTICLES_PATH = f'enwiki-{DUMP_VERSION}-pages-articles-multistream1.xml.bz2'
-INDEX_PATH = f'enwiki-{DUMP_VERSION}-pages-articles-multistream-index1.txt.bz2'
-CLEAN_INDEX_PATH = f'enwiki-{DUMP_VERSION}-pages-articles-multistream-index1.txt'
+# Input and output paths. Every multistream part of the dump in DUMP_DIR that has a
+# matching index file is extracted, e.g. enwiki-20230301-pages-articles-multistream1.xml-p1p41242.bz2
+# and enwiki-20230301-pages-articles-multistream-index1.txt-p1p41242.bz2
+DUMP_DIR = './'
+DUMP_PREFIX = f'enwiki-{DUMP_VERSION}'
+# Default output directory, changed with --output
 OUTPUT_PARQUET_PATH = 'wiki_parquet/'
+# Ledger of completed blocks, kept next to the Parquet files. Sharded runs write one per shard,
+# e.g. manifest-shard001-of-004.jsonl, which --merge combines into this one
+MANIFEST_NAME = 'manifest.jsonl'
+
+# Parquet output parameters. The chunk schema, compression, shard size and row group size are set in
+# parquet_sink.py, so benchmark-pipeline.py writes the same shards
+
+# With --pretokenize, the chunks also get the token ids the encoder configured in encoders.py feeds its model,
+# special tokens included, and their number. The tokenizer and length are recorded in the schema metadata, so
+# create-wiki-vdb-2.0.py only uses the ids if they match its encoder
+PRETOKENIZED_SCHEMA = PARQUET_SCHEMA.append(pa.field('input_ids', pa.list_(pa.int32()))) \
+    .append(pa.field('num_tokens', pa.int32())) \
+    .with_metadata({'tokenizer': ENCODER_MODEL, 'max_seq_length': str(MAX_SEQ_LENGTH)})
+# Page -> revision manifest, written to the pages/ subdirectory. It lists every article in the dump,
+# including the unchanged ones an incremental run doesn't chunk, so the next run can compare against it
+PAGES_SCHEMA = pa.schema([('index', pa.int32()), ('revision', pa.int64()), ('sha1', pa.string()),
+                          ('status', pa.string())])
+PAGES_DIR = 'pages'
+# Pages added, changed or deleted since the previous run, read by create-wiki-vdb-2.0.py --incremental.
+# It lives in its own subdirectory so it isn't mistaken for a chunk shard
+PAGE_CHANGES_NAME = 'changes/page_changes.parquet'
+
+# A pages row is a few dozen bytes, so pages shards are kept much smaller. Blocks are only complete once
+# their pages shard is closed, which otherwise wouldn't happen before the end of the run
+PAGES_TARGET_SHARD_BYTES = 16 * 1024 * 1024
+
+# Chunking parameters. Without a tokenizer, chunks are budgeted in whitespace-separated words (75% of 512).
+# Set CHUNK_TOKENIZER to a Hugging Face model name to budget in that model's tokens instead, e.g.
+# 'sentence-transformers/multi-qa-MiniLM-L6-cos-v1' with CHUNK_MAX_TOKENS = 510 ([CLS] and [SEP] take the rest)
+CHUNK_TOKENIZER = None
+CHUNK_MAX_TOKENS = 350
+CHUNK_OVERLAP = 0
+# With --pretokenize and no CHUNK_TOKENIZER, chunks are budgeted in the encoder's tokens instead, up to
+# the model's whole sequence, so the token count of every chunk is exact and none is truncated
+PRETOKENIZED_CHUNK_MAX_TOKENS = MAX_SEQ_LENGTH - 2
 
 # Processing parameters
 NUM_PROCESSORS = 16
 NUM_PARALLEL_BLOCKS = 20
+# Maximum number of blocks handed to the pool but not yet finished
+MAX_QUEUED_BLOCKS = NUM_PROCESSORS * 2
+# Index of the first stream to extract in every part, so a run can start anywhere in a part
+START_STREAM = 0
 
+# Per-stage metrics are appended to this JSON lines file in the output directory every METRICS_INTERVAL
+# seconds and at the end of the run; sharded runs write metrics-shard001-of-004.jsonl and so on
+METRICS_NAME = 'metrics.jsonl'
+METRICS_INTERVAL = 60
 
-def get_article_offsets(index_path: str, clean_index_path: str) -> List[int]:
+
+def partition_list(input_list: List, chunk_size: int) -> Generator[List, None, None]:
     """
-    Returns the offsets of the start of each Wikipedia article within the bz2 file.
-    If the cleaned index file already exists, the function simply reads the offsets from this file.
-    Otherwise, it calculates the offsets from the original index file and writes them to the cleaned index file.
+    Splits a list into smaller chunks of a given size. 
+    Returns a generator that yields these chunks one by one.
     """
-    if not os.path.isfile(clean_index_path):
-        article_offsets = []
-        last_offset = None
-        with open(index_path, 'rb') as f:
-            compressed_data = bz2.decompress(f.read()).split(b'\n')
-            if compressed_data[-1] == b'':
-                compressed_data = compressed_data[:-1]
-            for line in tqdm(compressed_data, desc="Processing Article Offsets", total=len(compressed_data)):
-                offset = line.decode().split(':', 1)[0]
-                if last_offset != offset:
-                    last_offset = offset
-                    article_offsets.append(int(offset))
-
-        with open(clean_index_path, 'w') as f:
-            f.write(','.join([str(i) for i in article_offsets]))
-    else:
-        with open(clean_index_path, 'r') as f:
-            article_offsets = [int(idx) for idx in f.read().split(',')]
-
-    return article_offsets
+    for i in range(0, len(input_list), chunk_size):
+        yield input_list[i:i+chunk_size]
 
 
-def extract_article_data(article_path: str, offset_list: List[int]) -> Generator[bytes, None, None]:
+def init_worker(article_paths: Dict[str, str], previous_pages_path: Optional[str], pretokenize: bool) -> None:
     """
-    Extracts the raw byte data for each Wikipedia article from the bz2 file.
+    Runs once in every worker of the long-lived pool. Loads the chunking tokenizer and memory-maps
+    the previous run's pages, so both are shared by all the blocks that worker processes.
+    The bz2 files of the parts are memory-mapped the first time the worker gets a block from them.
+    With pretokenize, also loads the encoder's tokenizer.
     """
-    with open(article_path, "rb") as f:
-        last_offset = offset_list[0]
-        f.read(last_offset)
-        for next_offset in offset_list[1:]:
-            offset = next_offset - last_offset
-            last_offset = next_offset
-            yield f.read(offset)
-
-
-def parse_article_data(byte_string_compressed: bytes) -> pd.DataFrame:
+    global dumps, dump_paths, previous_pages, tokenizer, chunk_max_tokens, encoder_tokenizer
+    dumps = {}
+    dump_paths = article_paths
+    previous_pages = None
+    if previous_pages_path is not None:
+        previous_pages = tuple(np.load(os.path.join(previous_pages_path, f'{name}.npy'), mmap_mode='r')
+                               for name in ('ids', 'sha1s'))
+    tokenizer = None
+    chunk_max_tokens = CHUNK_MAX_TOKENS
+    if CHUNK_TOKENIZER is not None:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(CHUNK_TOKENIZER, use_fast=True)
+    encoder_tokenizer = load_tokenizer() if pretokenize else None
+    if encoder_tokenizer is not None and tokenizer is None:
+        tokenizer = encoder_tokenizer
+        chunk_max_tokens = PRETOKENIZED_CHUNK_MAX_TOKENS
+
+
+def get_page_status(page_id: int, sha1: str) -> str:
     """
-    Parses the raw byte data of a Wikipedia article and returns a pandas DataFrame containing the article ID, title, and text.
+    Returns whether a page was 'added' or 'changed' since the previous run, or is 'unchanged'.
+    Without a previous run every page counts as added.
     """
-    def _extract_text(list_xml_el):
-        return [el.text for el in list_xml_el]
-
-    def _extract_id(list_xml_el):
-        return [int(el.text) for el in list_xml_el]
+    if previous_pages is None:
+        return 'added'
+    previous_ids, previous_sha1s = previous_pages
+    position = np.searchsorted(previous_ids, page_id)
+    if position == len(previous_ids) or previous_ids[position] != page_id:
+        return 'added'
+    return 'unchanged' if previous_sha1s[position] == sha1.encode() else 'changed'
 
-    decompressor = BZ2Decompressor()
-    byte_string = decompressor.decompress(byte_string_compressed)
-    doc = etree.parse(io.BytesIO(b'<root> ' + byte_string + b' </root>'))
 
-    id_column = _extract_id(doc.xpath('*/id'))
-    title_column = _extract_text(doc.xpath('*/title'))
-    article_column = _extract_text(doc.xpath('*/revision/text'))
-
-    df = pd.DataFrame([id_column, title_column, article_column], index=[
-                      'index', 'title', 'article']).T
-    df['index'] = df['index'].astype(np.int32)
-    return df
-
-
-def partition_list(input_list: List, chunk_size: int) -> Generator[List, None, None]:
+def process_articles_in_parallel(part_name: str, first_stream: int, stream_ranges: List[Tuple[int, int]],
+                                 chunk: bool = True) -> Tuple[dict, pa.Table, pa.Table, dict]:
     """
-    Splits a list into smaller chunks of a given size. 
-    Returns a generator that yields these chunks one by one.
+    Processes a list of (start, end) stream ranges of one dump part in parallel using multiple processors.
+    Each worker reads its own streams from the memory-mapped bz2 file and returns the chunks as an Arrow table,
+    which the parent hands to the Parquet writer, along with the pages of the block, the block and its row counts,
+    and the timings of its read, decompress, parse, clean and chunk stages.
+    Pages that are unchanged since the previous run are recorded but not cleaned or chunked.
+    Without chunk, for a block whose chunks an interrupted run already wrote, no page is.
+    With --pretokenize, the chunks of the whole block are then tokenized in one batch.
+    Streams that fail are listed in the entry's failed_streams, and the parent doesn't record the block.
     """
-    for i in range(0, len(input_list), chunk_size):
-        yield input_list[i:i+chunk_size]
-
+    block_start_time = time.perf_counter()
+    metrics = PipelineMetrics()
+    if part_name not in dumps:
+        dumps[part_name] = open_dump(dump_paths[part_name])
+    dump = dumps[part_name]
+    ids, revisions, titles, chunks = [], [], [], []
+    pages = {name: [] for name in PAGES_SCHEMA.names}
+    failed_streams = []
+    for stream, (start, end) in enumerate(stream_ranges, first_stream):
+        try:
+            with metrics.stage('read', bytes=end - start):
+                compressed = read_stream(dump, start, end)
+            with metrics.stage('decompress', bytes=len(compressed)):
+                xml = decompress_stream(compressed)
+            with metrics.stage('parse', bytes=len(xml)) as counts:
+                df = parse_pages(xml)
+                counts['pages'] = len(df)
+            stream_ids, stream_revisions, stream_titles, stream_chunks = [], [], [], []
+            stream_statuses = []
+            for page_id, revision, sha1, title, article in zip(df['index'], df['revision'], df['sha1'],
+                                                              df['title'], df['article']):
+                status = get_page_status(page_id, sha1)
+                stream_statuses.append(status)
+                if status == 'unchanged' or not chunk:
+                    continue
+                with metrics.stage('clean', pages=1):
+                    text = clean_wiki_text(article)
+                with metrics.stage('chunk', pages=1) as counts:
+                    article_chunks = split_text_into_chunks(text, max_tokens=chunk_max_tokens,
+                                                            overlap=CHUNK_OVERLAP, tokenizer=tokenizer)
+                    counts['chunks'] = len(article_chunks)
+                stream_ids.extend([page_id] * len(article_chunks))
+                stream_revisions.extend([revision] * len(article_chunks))
+                stream_titles.extend([title] * len(article_chunks))
+                stream_chunks.extend(article_chunks)
+            ids.extend(stream_ids)
+            revisions.extend(stream_revisions)
+            titles.extend(stream_titles)
+            chunks.extend(stream_chunks)
+            pages['index'].extend(df['index'])
+            pages['revision'].extend(df['revision'])
+            pages['sha1'].extend(df['sha1'])
+            pages['status'].extend(stream_statuses)
+        except Exception as e:
+            # If an error occurs, log the error message and the stream. The rest of the block is still
+            # processed, so all of its failures show up in one run
+            print(f"Error processing stream {stream} of {part_name}: '{e}")
+            print(traceback.format_exc())
+            failed_streams.append(stream)
+            continue
 
-def clean_wiki_text(raw_text):
-    # Clean Wikipedia text
-    wikicode = mwparserfromhell.parse(raw_text)
-    intermediate_text = wikicode.strip_code()
+    entry = {'part': part_name, 'streams': [first_stream, first_stream + len(stream_ranges)],
+             'rows': len(chunks), 'pages': len(pages['index']), 'failed_streams': failed_streams}
+    columns = {'index': pa.array(ids, pa.int32()), 'revision': pa.array(revisions, pa.int64()),
+               'title': titles, 'chunks': chunks}
+    schema = PARQUET_SCHEMA
+    if encoder_tokenizer is not None:
+        with metrics.stage('tokenize', chunks=len(chunks)):
+            input_ids = tokenize_texts(encoder_tokenizer, chunks)
+            num_tokens = np.array([len(ids) for ids in input_ids], dtype=np.int32)
+            offsets = np.zeros(len(chunks) + 1, dtype=np.int32)
+            np.cumsum(num_tokens, out=offsets[1:])
+            values = np.fromiter((token_id for ids in input_ids for token_id in ids), dtype=np.int32,
+                                 count=int(offsets[-1]))
+            columns['input_ids'] = pa.ListArray.from_arrays(pa.array(offsets), pa.array(values))
+            columns['num_tokens'] = pa.array(num_tokens)
+        schema = PRETOKENIZED_SCHEMA
+    table = pa.table(columns, schema=schema)
+    pages_table = pa.table(pages, schema=PAGES_SCHEMA)
+    metrics.add_busy_time(f'worker-{os.getpid()}', time.perf_counter() - block_start_time)
+    return entry, table, pages_table, metrics.snapshot()
+
+
+def get_shard_name(part_name: str, first_stream: int) -> str:
+    return '{}-{:08d}'.format(part_name, first_stream)
+
+
+def get_completed_shards(entries: List[dict], kind: str, count_key: str, output_dir: str) -> Set[str]:
+    """
+    Returns the Parquet shards of the given kind listed in the manifest entries whose footer can be
+    read and whose row count matches the sum of the count_key counts of their blocks.
+    """
+    shard_rows = {}
+    for entry in entries:
+        if entry['kind'] == kind and entry['output'] is not None:
+            shard_rows[entry['output']] = shard_rows.get(entry['output'], 0) + entry[count_key]
 
-    # Split text into lines and remove consecutive empty lines
-    lines = intermediate_text.split('\n')
-    clean_lines = [line for line, prev_line in zip(
-        lines[1:], lines) if line.strip() or prev_line.strip()]
+    complete_shards = set()
+    for file_name, rows in shard_rows.items():
+        try:
+            num_rows = pq.ParquetFile(os.path.join(output_dir, file_name)).metadata.num_rows
+        except (OSError, pa.ArrowInvalid):
+            continue
+        if num_rows == rows:
+            complete_shards.add(file_name)
+    return complete_shards
 
-    clean_text = '\n'.join(clean_lines)
-    return clean_text
 
+def get_completed_entries(manifest_path: str, output_dir: str) -> List[dict]:
+    """
+    Returns the manifest entries whose shard is complete. Every block has one entry for its chunks and
+    one for its pages, each recorded once the shard holding those rows is closed. A shard that is
+    missing or whose footer can't be read or doesn't match the recorded row count is treated as
+    unfinished, and the rows of its blocks are written again.
+    """
+    entries = load_manifest(manifest_path)
+    complete_shards = {'chunks': get_completed_shards(entries, 'chunks', 'rows', output_dir),
+                       'pages': get_completed_shards(entries, 'pages', 'pages', os.path.join(output_dir, PAGES_DIR))}
+    return [entry for entry in entries if entry['output'] is None or entry['output'] in complete_shards[entry['kind']]]
 
-def split_text_into_chunks(text):
-    # Split text into paragraphs
-    paragraphs = text.split("\n")
-    chunks = []
-    current_chunk = ""
 
-    # Maximum words per chunk (75% of 512)
-    max_words_per_chunk = 350
+def get_completed_kinds(entries: List[dict]) -> Dict[Tuple[str, int, int], Set[str]]:
+    """
+    Returns the kinds of rows ('chunks', 'pages') recorded for every block, by part name and
+    (first, last + 1) stream numbers.
+    """
+    kinds = {}
+    for entry in entries:
+        kinds.setdefault((entry['part'], *entry['streams']), set()).add(entry['kind'])
+    return kinds
 
-    # Create chunks that don't exceed the word limit
-    for paragraph in paragraphs:
-        num_words_current = len(current_chunk.split())
-        num_words_new = len(paragraph.split())
 
-        if num_words_current + num_words_new > max_words_per_chunk:
-            current_chunk = current_chunk.strip()
-            if current_chunk:
-                chunks.append(current_chunk)
-            current_chunk = paragraph
-        else:
-            current_chunk += "\n" + paragraph
+def get_completed_blocks(entries: List[dict]) -> Set[Tuple[str, int, int]]:
+    """
+    Returns the blocks whose chunks and pages are both recorded.
+    """
+    return {block for block, kinds in get_completed_kinds(entries).items() if kinds == {'chunks', 'pages'}}
 
-    # Add the last chunk if it's not empty
-    if current_chunk.strip():
-        chunks.append(current_chunk)
 
-    return chunks
+def remove_unfinished_shards(output_dir: str, shard_names: Set[str], entries: List[dict]) -> None:
+    """
+    Removes the shards named after the given blocks, finished or not, that no completed entry refers to:
+    files left behind by a killed run, or by an earlier run whose blocks are written again. They would
+    otherwise be loaded as duplicate rows. Shards sharing an output directory only remove their own.
+    """
+    kept = {(entry['kind'], entry['output']) for entry in entries}
+    for kind, shard_dir in (('chunks', output_dir), ('pages', os.path.join(output_dir, PAGES_DIR))):
+        for file_name in os.listdir(shard_dir):
+            name, extension = file_name.split('.', 1) if '.' in file_name else (file_name, '')
+            if extension in ('parquet', 'parquet.tmp') and name in shard_names \
+                    and (kind, file_name) not in kept:
+                print(f"Removing unfinished shard {os.path.join(shard_dir, file_name)}")
+                os.remove(os.path.join(shard_dir, file_name))
 
 
-def process_articles_in_parallel(list_bytes: List[bytes]) -> None:
+def read_pages(output_dir: str, columns: List[str]) -> pa.Table:
     """
-    Processes a list of raw byte data for Wikipedia articles in parallel using multiple processors.
-    Writes the processed data to Parquet files.
+    Reads the given columns of the page -> revision manifest of a run.
     """
-    df_list = []
-    for article in tqdm(list_bytes, desc="Processing Articles", total=len(list_bytes)):
-        df = parse_article_data(article)
-        df = df[~df['article'].apply(
-            lambda x: x.lower().startswith('#redirect'))]
-        df['article'] = df['article'].apply(clean_wiki_text)
-        df['chunks'] = df['article'].apply(split_text_into_chunks)
-        df = df.explode('chunks').reset_index(drop=True)
-        df.drop(columns=['article'], inplace=True)
-        df_list.append(df)
+    pages_dir = os.path.join(output_dir, PAGES_DIR)
+    tables = [pq.read_table(os.path.join(pages_dir, file_name), columns=columns)
+              for file_name in sorted(os.listdir(pages_dir)) if file_name.endswith('.parquet')]
+    return pa.concat_tables(tables) if tables else PAGES_SCHEMA.empty_table().select(columns)
 
-    output_file_path = os.path.join(
-        OUTPUT_PARQUET_PATH, '{:08d}.parquet'.format(df_list[0]['index'].values[0]))
 
-    df_combined = pd.concat(df_list, ignore_index=True)
-    df_combined.to_parquet(output_file_path, compression='snappy', index=False)
-    del df_combined
+def save_previous_pages(previous_run: str, output_dir: str) -> str:
+    """
+    Saves the page ids and sha1s of a previous run as sorted .npy files that the workers memory-map,
+    and returns the directory they are in. Shards sharing the output directory each save them, so the files
+    are replaced rather than rewritten in place, which would change them under another shard's workers.
+    """
+    pages = read_pages(previous_run, ['index', 'sha1'])
+    ids = pages.column('index').to_numpy().astype(np.int64)
+    order = np.argsort(ids, kind='stable')
+    previous_pages_path = os.path.join(output_dir, 'previous-pages')
+    os.makedirs(previous_pages_path, exist_ok=True)
+    arrays = {
+        'ids': ids[order],
+        'sha1s': np.array(pages.column('sha1').to_pylist(), dtype='S')[order],
+    }
+    for name, values in arrays.items():
+        # Named after the process, so two shards never write the same temporary file
+        tmp_path = os.path.join(previous_pages_path, f'{name}.{os.getpid()}.tmp.npy')
+        np.save(tmp_path, values)
+        os.replace(tmp_path, os.path.join(previous_pages_path, f'{name}.npy'))
+    return previous_pages_path
+
+
+def write_page_changes(previous_run: str, output_dir: str) -> None:
+    """
+    Writes the pages added, changed or deleted since the previous run to PAGE_CHANGES_NAME.
+    Deleted pages are those in the previous run's manifest that are no longer in this one;
+    they get a revision of -1 so that all of their rows are removed.
+    """
+    pages = read_pages(output_dir, ['index', 'revision', 'status'])
+    changed = pages.filter(pc.not_equal(pages.column('status'), 'unchanged'))
+    previous_ids = read_pages(previous_run, ['index']).column('index').to_numpy()
+    deleted_ids = np.setdiff1d(previous_ids, pages.column('index').to_numpy())
+    deleted = pa.table({'index': pa.array(deleted_ids, pa.int32()),
+                        'revision': pa.array(np.full(len(deleted_ids), -1), pa.int64()),
+                        'status': pa.array(['deleted'] * len(deleted_ids), pa.string())})
+    page_changes_path = os.path.join(output_dir, PAGE_CHANGES_NAME)
+    os.makedirs(os.path.dirname(page_changes_path), exist_ok=True)
+    pq.write_table(pa.concat_tables([changed, deleted]), page_changes_path)
+    print(f"{changed.num_rows} pages added or changed and {len(deleted_ids)} deleted since {previous_run}")
+
+
+def plan_blocks(parts: List[DumpPart]) -> List[Tuple[str, int, List[Tuple[int, int]]]]:
+    """
+    Returns every block of every part as (part name, first stream, stream ranges), in part and stream order.
+    The order only depends on the dump and NUM_PARALLEL_BLOCKS, so every machine computes the same list.
+    """
+    blocks = []
+    for part in parts:
+        offset_index = load_offset_index(part.index_path, part.article_path, part.index_cache_path)
+        stream_ranges = get_stream_ranges(offset_index)
+        for first, block in zip(range(START_STREAM, len(stream_ranges), NUM_PARALLEL_BLOCKS),
+                                partition_list(stream_ranges[START_STREAM:], NUM_PARALLEL_BLOCKS)):
+            blocks.append((part.name, first, block))
+    return blocks
 
 
-def process_articles_in_parallel(list_bytes: List[bytes]) -> None:
+def merge_manifests(parts: List[DumpPart], output_dir: str) -> None:
+    """
+    Combines the manifests written by all shards into MANIFEST_NAME, after checking that every block
+    of the dump was completed by exactly one shard and that the shards' Parquet files are complete.
+    """
+    shard_manifests = sorted(file_name for file_name in os.listdir(output_dir)
+                             if file_name.startswith('manifest-shard') and file_name.endswith('.jsonl'))
+    completed = {}
+    shard_entries = {}
+    for file_name in shard_manifests:
+        shard_entries[file_name] = get_completed_entries(os.path.join(output_dir, file_name), output_dir)
+        for block in get_completed_blocks(shard_entries[file_name]):
+            completed.setdefault(block, []).append(file_name)
+
+    expected = {(part_name, first, first + len(block)) for part_name, first, block in plan_blocks(parts)}
+    missing = expected - completed.keys()
+    duplicated = [block for block, manifests in completed.items() if len(manifests) > 1]
+    for part_name, first, end in sorted(missing):
+        print(f"Missing: {part_name} streams {first}-{end}")
+    for part_name, first, end in sorted(duplicated):
+        print(f"Completed by more than one shard: {part_name} streams {first}-{end} ({', '.join(completed[(part_name, first, end)])})")
+    if missing or duplicated:
+        raise SystemExit(f"Verification failed: {len(missing)} blocks missing, {len(duplicated)} duplicated")
+
+    manifest_path = os.path.join(output_dir, MANIFEST_NAME)
+    reset_manifest(manifest_path)
+    for file_name in shard_manifests:
+        for entry in shard_entries[file_name]:
+            if (entry['part'], *entry['streams']) in expected:
+                append_manifest(manifest_path, entry)
+    print(f"Verified {len(expected)} blocks from {len(shard_manifests)} shards, merged into {MANIFEST_NAME}")
+
+
+def main():
     """
-    Processes a list of raw byte data for Wikipedia articles in parallel using multiple processors.
-    Writes the processed data to Parquet files.
+    Feeds blocks of stream ranges to one long-lived worker pool. At most MAX_QUEUED_BLOCKS
+    blocks are in flight at any time: the reader blocks until a worker finishes, which keeps
+    every core busy without letting the queue (and memory use) grow.
+    Finished blocks are written to size-targeted Parquet shards, and their chunks and pages are each
+    recorded in the manifest once their shard is closed, so --resume can skip them after a crash.
+    With --num-shards, each machine only processes the blocks its --shard owns.
+    With --previous-run, pages whose sha1 matches the previous run are recorded but not chunked.
     """
-    df_list = []
-    for article in list_bytes:
+    parser = argparse.ArgumentParser(description="Extract Wikipedia articles into chunked Parquet files.")
+    parser.add_argument('--output', metavar='DIR', default=OUTPUT_PARQUET_PATH,
+                        help="directory the Parquet files, manifest and metrics are written to (default: %(default)s)")
+    parser.add_argument('--resume', action='store_true',
+                        help="skip the blocks recorded as complete in the manifest")
+    parser.add_argument('--merge', action='store_true',
+                        help="verify the manifests of all shards cover the dump and merge them, then exit")
+    parser.add_argument('--previous-run', metavar='DIR',
+                        help="output directory of the previous dump's run; only pages added or changed "
+                             "since then are chunked, and the changes are listed in " + PAGE_CHANGES_NAME)
+    parser.add_argument('--pretokenize', action='store_true',
+                        help="also store the token ids of every chunk for the encoder configured in encoders.py, "
+                             "so create-wiki-vdb-2.0.py doesn't tokenize again, and budget chunks in its tokens")
+    parser.add_argument('--metrics', metavar='FILE',
+                        help="JSON lines file the per-stage metrics are appended to "
+                             "(default: " + METRICS_NAME + " in the output directory)")
+    parser.add_argument('--prometheus', metavar='FILE',
+                        help="also keep the metrics in this file in the Prometheus text format")
+    add_shard_arguments(parser)
+    args = parser.parse_args()
+    check_shard_arguments(parser, args)
+    output_dir = args.output
+    # The previous run's pages and chunk shards would be mixed with this run's
+    if args.previous_run and os.path.realpath(args.previous_run) == os.path.realpath(output_dir):
+        parser.error("--previous-run must be another directory than --output, e.g. move the previous run "
+                     "aside or pass a new --output")
+
+    os.makedirs(os.path.join(output_dir, PAGES_DIR), exist_ok=True)
+    parts = find_dump_parts(DUMP_DIR, DUMP_PREFIX)
+    if args.merge:
+        merge_manifests(parts, output_dir)
+        if args.previous_run:
+            write_page_changes(args.previous_run, output_dir)
+        return
+
+    manifest_name = MANIFEST_NAME
+    if args.num_shards > 1:
+        manifest_name = 'manifest{}.jsonl'.format(get_shard_suffix(args.shard, args.num_shards))
+    manifest_path = os.path.join(output_dir, manifest_name)
+    metrics_path = args.metrics or os.path.join(
+        output_dir, METRICS_NAME.replace('.jsonl', get_shard_suffix(args.shard, args.num_shards) + '.jsonl'))
+    # The manifest is rewritten with only the entries of complete shards, so the rows of a shard that is
+    # written again under the same name aren't added to those of its unfinished predecessor
+    entries = get_completed_entries(manifest_path, output_dir) if args.resume else []
+    reset_manifest(manifest_path)
+    for entry in entries:
+        append_manifest(manifest_path, entry)
+    completed = get_completed_kinds(entries)
+    blocks = select_shard(plan_blocks(parts), args.shard, args.num_shards)
+    # Shards are named after the part and first stream of their first block, so parts never collide
+    remove_unfinished_shards(output_dir, {get_shard_name(part_name, first) for part_name, first, _ in blocks},
+                             entries)
+    previous_pages_path = save_previous_pages(args.previous_run, output_dir) if args.previous_run else None
+
+    # Blocks of all parts go into one queue, largest first by compressed size, so the small
+    # blocks at the end of each part fill in the gaps at the end of the run
+    blocks = [(part_name, first, block) for part_name, first, block in blocks
+              if completed.get((part_name, first, first + len(block))) != {'chunks', 'pages'}]
+    blocks.sort(key=lambda block: block[2][-1][1] - block[2][0][0], reverse=True)
+    num_streams = sum(len(block) for _, _, block in blocks)
+    print(f"Found {len(parts)} dump parts, {num_streams} streams to process")
+
+    queue_slots = threading.BoundedSemaphore(MAX_QUEUED_BLOCKS)
+    errors = []
+    # Blocks with streams that failed. Their rows aren't written and they aren't recorded, so --resume retries them
+    failed_blocks = []
+    metrics = PipelineMetrics()
+    metrics_labels = {'pipeline': 'extract', 'shard': args.shard, 'num_shards': args.num_shards}
+    last_metrics_time = time.time()
+    progress = tqdm(total=num_streams, desc="Processing Streams", unit="stream")
+
+    # The chunks and the pages of a block are each recorded once the shard holding them has been renamed
+    # into place. The callbacks run in the pool's result thread or, at the end, the main thread
+    def _on_shard_closed(file_name, entries):
+        for entry in entries:
+            entry['output'] = file_name
+            append_manifest(manifest_path, entry)
+
+    writer = ParquetShardWriter(output_dir, PRETOKENIZED_SCHEMA if args.pretokenize else PARQUET_SCHEMA,
+                                TARGET_SHARD_BYTES, ROW_GROUP_SIZE,
+                                compression=PARQUET_COMPRESSION, compression_level=PARQUET_COMPRESSION_LEVEL,
+                                dictionary_columns=['title'],
+                                on_shard_closed=_on_shard_closed)
+    pages_writer = ParquetShardWriter(os.path.join(output_dir, PAGES_DIR), PAGES_SCHEMA,
+                                      PAGES_TARGET_SHARD_BYTES, ROW_GROUP_SIZE, compression=PARQUET_COMPRESSION,
+                                      compression_level=PARQUET_COMPRESSION_LEVEL, dictionary_columns=['status'],
+                                      on_shard_closed=_on_shard_closed)
+
+    # Runs in the pool's result thread, which makes it the single writer stage
+    def _on_done(result):
+        nonlocal last_metrics_time
+        entry, table, pages_table, block_metrics = result
         try:
-            df = parse_article_data(article)
-            df = df[~df['article'].apply(
-                lambda x: x.lower().startswith('#redirect'))]
-            df['article'] = df['article'].apply(clean_wiki_text)
-            df['chunks'] = df['article'].apply(split_text_into_chunks)
-            df = df.explode('chunks').reset_index(drop=True)
-            df.drop(columns=['article'], inplace=True)
-            df_list.append(df)
+            metrics.merge(block_metrics)
+            progress.update(entry['streams'][1] - entry['streams'][0])
+            if entry['failed_streams']:
+                failed_blocks.append(entry)
+                return
+            shard_name = get_shard_name(entry['part'], entry['streams'][0])
+            done = completed.get((entry['part'], *entry['streams']), set())
+            with metrics.stage('parquet_write', bytes=table.nbytes + pages_table.nbytes,
+                               pages=pages_table.num_rows, chunks=table.num_rows):
+                for kind, shard_writer, kind_table, count_key in (('chunks', writer, table, 'rows'),
+                                                                  ('pages', pages_writer, pages_table, 'pages')):
+                    if kind in done:
+                        continue
+                    kind_entry = {'part': entry['part'], 'streams': entry['streams'], 'kind': kind,
+                                  'output': None, count_key: entry[count_key]}
+                    if kind_table.num_rows:
+                        shard_writer.write(kind_table, shard_name, kind_entry)
+                    else:
+                        # Blocks made up entirely of redirects or unchanged pages have nothing to write
+                        append_manifest(manifest_path, kind_entry)
+            if time.time() - last_metrics_time >= METRICS_INTERVAL:
+                metrics.write(metrics_path, args.prometheus, **metrics_labels)
+                last_metrics_time = time.time()
         except Exception as e:
-            # If an error occurs, log the error message and the title of the article
-            print(f"Error processing article: '{e}")
-            print(traceback.format_exc())
-            continue
-
-    output_file_path = os.path.join(
-        OUTPUT_PARQUET_PATH, '{:08d}.parquet'.format(df_list[0]['index'].values[0]))
-    df_combined = pd.concat(df_list, ignore_index=True)
-    df_combined.to_parquet(output_file_path, compression='snappy', index=False)
-    del df_combined
-
-
-# Main process
-articles_queue = []
-article_offsets = get_article_offsets(INDEX_PATH, CLEAN_INDEX_PATH)
-for byte_string in tqdm(extract_article_data(ARTICLES_PATH, article_offsets), desc="Offsets Loaded", total=len(article_offsets)):
-    if len(articles_queue) < NUM_PROCESSORS * NUM_PARALLEL_BLOCKS:
-        articles_queue.append(byte_string)
-    else:
-        with Pool(processes=NUM_PROCESSORS) as pool:
-            tuple(pool.imap_unordered(process_articles_in_parallel,
-                  partition_list(articles_queue, NUM_PARALLEL_BLOCKS)))
-        for el in articles_queue:
-            del el
-        articles_queue.clear()
-
-with Pool(processes=NUM_PROCESSORS) as pool:
-    tuple(pool.imap_unordered(process_articles_in_parallel,
-          partition_list(articles_queue, NUM_PARALLEL_BLOCKS)))
-for el in articles_queue:
-    del el
-articles_queue.clear()
-
-print("Done.")
+            errors.append(e)
+        finally:
+            queue_slots.release()
+
+    def _on_error(e):
+        errors.append(e)
+        queue_slots.release()
+
+    start_time = time.time()
+    article_paths = {part.name: part.article_path for part in parts}
+    with Pool(processes=NUM_PROCESSORS, initializer=init_worker,
+              initargs=(article_paths, previous_pages_path, args.pretokenize)) as pool:
+        for part_name, first, block in blocks:
+            queue_slots.acquire()
+            if errors:
+                break
+            chunk = 'chunks' not in completed.get((part_name, first, first + len(block)), set())
+            pool.apply_async(process_articles_in_parallel, (part_name, first, block, chunk),
+                             callback=_on_done, error_callback=_on_error)
+        pool.close()
+        pool.join()
+    with metrics.stage('parquet_write'):
+        writer.close()
+        pages_writer.close()
+    progress.close()
+    metrics.write(metrics_path, args.prometheus, **metrics_labels)
+
+    if errors:
+        raise errors[0]
+    # The pages of failed streams are missing, so page_changes would list them as deleted
+    if failed_blocks:
+        for entry in failed_blocks:
+            print(f"Failed: {entry['part']} streams {', '.join(map(str, entry['failed_streams']))}")
+        raise SystemExit(f"{len(failed_blocks)} blocks had streams that failed and weren't recorded; "
+                         f"run again with --resume to retry them. {PAGE_CHANGES_NAME} wasn't written")
+
+    # Sharded runs list the changes once all shards are done, with --merge
+    if args.previous_run and args.num_shards == 1:
+        write_page_changes(args.previous_run, output_dir)
+
+    elapsed_time = time.time() - start_time
+    print(f"Processed {num_streams} streams in {elapsed_time:.1f} seconds "
+          f"({num_streams / max(elapsed_time, 1e-9):.1f} streams/sec)")
+    metrics.print_summary()
+    print("Done.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+import os
+import json
+from typing import List
+
+
+def load_manifest(manifest_path: str) -> List[dict]:
+    """
+    Returns the entries recorded in a JSONL manifest, or an empty list if it doesn't exist.
+    A trailing line that was cut off by a crash is ignored.
+    """
+    entries = []
+    if not os.path.isfile(manifest_path):
+        return entries
+    with open(manifest_path, 'r') as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except json.JSONDecodeError:
+                break
+    return entries
+
+
+def append_manifest(manifest_path: str, entry: dict) -> None:
+    """
+    Appends one entry to a JSONL manifest and flushes it to disk, so an entry is only ever
+    recorded once the work it describes is complete.
+    """
+    with open(manifest_path, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def reset_manifest(manifest_path: str) -> None:
+    """
+    Removes a manifest so a run starts from scratch.
+    """
+    if os.path.isfile(manifest_path):
+        os.remove(manifest_path)
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+# Upper bounds, in seconds, of the latency histogram buckets of every stage
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# Amounts a stage can count as it runs
+COUNTERS = ('bytes', 'pages', 'chunks')
+
+
+class PipelineMetrics:
+    """
+    Timers and counters for the stages of a run. Every timed call of a stage adds to its total time,
+    its latency histogram and its bytes, pages and chunks counts. Workers time what they do in their own
+    PipelineMetrics and send snapshot() back with their results, which the parent merges into its own.
+    Busy time is kept per worker, so the utilization of each one can be reported.
+    Stages running in different threads can record into the same PipelineMetrics.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.workers = {}
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+
+    def _get_stage(self, name: str) -> dict:
+        if name not in self.stages:
+            self.stages[name] = {'calls': 0, 'seconds': 0.0, **{counter: 0 for counter in COUNTERS},
+                                 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)}
+        return self.stages[name]
+
+    def record(self, name: str, seconds: float, **counts: int) -> None:
+        """
+        Records one call of a stage that took the given number of seconds.
+        """
+        bucket = 0
+        while bucket < len(LATENCY_BUCKETS) and seconds > LATENCY_BUCKETS[bucket]:
+            bucket += 1
+        with self.lock:
+            stage = self._get_stage(name)
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            for counter, count in counts.items():
+                stage[counter] += count
+            stage['buckets'][bucket] += 1
+
+    @contextmanager
+    def stage(self, name: str, **counts: int) -> Iterator[dict]:
+        """
+        Times the body of the with statement as one call of a stage. Counts only known at the end,
+        such as the number of chunks produced, can be set on the dict it yields.
+        """
+        counts = dict(counts)
+        start_time = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.record(name, time.perf_counter() - start_time, **counts)
+
+    def add_busy_time(self, worker: str, seconds: float) -> None:
+        with self.lock:
+            self.workers[worker] = self.workers.get(worker, 0.0) + seconds
+
+    def snapshot(self) -> dict:
+        """
+        Returns a copy of the stages and busy times, safe to read while other threads record.
+        """
+        with self.lock:
+            stages = {name: dict(stage, buckets=list(stage['buckets'])) for name, stage in self.stages.items()}
+            return {'stages': stages, 'workers': dict(self.workers)}
+
+    def merge(self, snapshot: dict) -> None:
+        """
+        Adds the stages and busy times of another PipelineMetrics' snapshot to these.
+        """
+        with self.lock:
+            for name, other in snapshot['stages'].items():
+                stage = self._get_stage(name)
+                for key in ('calls', 'seconds') + COUNTERS:
+                    stage[key] += other[key]
+                stage['buckets'] = [a + b for a, b in zip(stage['buckets'], other['buckets'])]
+        for worker, seconds in snapshot['workers'].items():
+            self.add_busy_time(worker, seconds)
+
+    def report(self, **labels) -> dict:
+        """
+        Returns the metrics as one JSON-serializable record: for each stage the totals, the mean latency
+        and throughput per second of stage time, and the histogram; and for each worker its busy time
+        and utilization over the run so far.
+        """
+        snapshot = self.snapshot()
+        elapsed_time = time.time() - self.start_time
+        stages = {}
+        for name, stage in snapshot['stages'].items():
+            seconds = max(stage['seconds'], 1e-9)
+            stages[name] = {
+                'calls': stage['calls'], 'seconds': round(stage['seconds'], 6),
+                **{counter: stage[counter] for counter in COUNTERS},
+                'mean_latency': stage['seconds'] / max(stage['calls'], 1),
+                **{f'{counter}_per_sec': stage[counter] / seconds for counter in COUNTERS if stage[counter]},
+                'buckets': dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], stage['buckets'])),
+            }
+        workers = {worker: {'busy_seconds': round(seconds, 6), 'utilization': seconds / max(elapsed_time, 1e-9)}
+                   for worker, seconds in sorted(snapshot['workers'].items())}
+        return {'time': time.time(), 'elapsed_seconds': elapsed_time, **labels,
+                'stages': stages, 'workers': workers}
+
+    def to_prometheus(self, prefix: str = 'wiki_pipeline', **labels) -> str:
+        """
+        Returns the metrics in the Prometheus text exposition format, e.g. for node_exporter's textfile collector.
+        """
+        snapshot = self.snapshot()
+        label_text = ''.join(f',{key}="{value}"' for key, value in labels.items())
+        lines = [f'# TYPE {prefix}_stage_seconds histogram']
+        for name, stage in sorted(snapshot['stages'].items()):
+            cumulative = 0
+            for bound, count in zip([str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'], stage['buckets']):
+                cumulative += count
+                lines.append(f'{prefix}_stage_seconds_bucket{{stage="{name}",le="{bound}"{label_text}}} {cumulative}')
+            lines.append(f'{prefix}_stage_seconds_sum{{stage="{name}"{label_text}}} {stage["seconds"]}')
+            lines.append(f'{prefix}_stage_seconds_count{{stage="{name}"{label_text}}} {stage["calls"]}')
+        for counter in COUNTERS:
+            lines.append(f'# TYPE {prefix}_stage_{counter}_total counter')
+            for name, stage in sorted(snapshot['stages'].items()):
+                lines.append(f'{prefix}_stage_{counter}_total{{stage="{name}"{label_text}}} {stage[counter]}')
+        elapsed_time = max(time.time() - self.start_time, 1e-9)
+        lines.append(f'# TYPE {prefix}_worker_busy_seconds_total counter')
+        for worker, seconds in sorted(snapshot['workers'].items()):
+            lines.append(f'{prefix}_worker_busy_seconds_total{{worker="{worker}"{label_text}}} {seconds}')
+        lines.append(f'# TYPE {prefix}_worker_utilization gauge')
+        for worker, seconds in sorted(snapshot['workers'].items()):
+            lines.append(f'{prefix}_worker_utilization{{worker="{worker}"{label_text}}} {seconds / elapsed_time}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, jsonl_path: Optional[str], prometheus_path: Optional[str] = None, **labels) -> None:
+        """
+        Appends the current report to a JSON lines file and, if a path is given, replaces a Prometheus text file.
+        """
+        if jsonl_path is not None:
+            with open(jsonl_path, 'a') as f:
+                f.write(json.dumps(self.report(**labels)) + '\n')
+        if prometheus_path is not None:
+            tmp_path = prometheus_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.to_prometheus(**labels))
+            os.replace(tmp_path, prometheus_path)
+
+    def print_summary(self) -> None:
+        """
+        Prints the time spent in each stage, so the stage that limits a run stands out.
+        """
+        snapshot = self.snapshot()
+        total_seconds = max(sum(stage['seconds'] for stage in snapshot['stages'].values()), 1e-9)
+        for name, stage in sorted(snapshot['stages'].items(), key=lambda item: item[1]['seconds'], reverse=True):
+            counts = ', '.join(f'{stage[counter]} {counter}' for counter in COUNTERS if stage[counter])
+            print(f"{name:>14}: {stage['seconds']:10.1f}s ({stage['seconds'] / total_seconds:5.1%})"
+                  f"{'  ' + counts if counts else ''}")
+        if snapshot['workers']:
+            elapsed_time = max(time.time() - self.start_time, 1e-9)
+            utilizations = [seconds / elapsed_time for seconds in snapshot['workers'].values()]
+            print(f"{len(snapshot['workers'])} workers, utilization mean {sum(utilizations) / len(utilizations):.1%}, "
+                  f"min {min(utilizations):.1%}")
+
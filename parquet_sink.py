@@ -0,0 +1,89 @@
+import os
+import pyarrow as pa
+import pyarrow.parquet as pq
+from typing import Callable, List, Optional
+
+# Chunk shards of extract-wiki-2.0.py, also written by benchmark-pipeline.py so it times the same output
+PARQUET_SCHEMA = pa.schema([('index', pa.int32()), ('revision', pa.int64()), ('title', pa.string()),
+                            ('chunks', pa.string())])
+PARQUET_COMPRESSION = 'zstd'
+PARQUET_COMPRESSION_LEVEL = 3
+TARGET_SHARD_BYTES = 512 * 1024 * 1024
+ROW_GROUP_SIZE = 100_000
+
+
+class ParquetShardWriter:
+    """
+    Writes Arrow tables into Parquet shards of roughly target_shard_bytes each.
+    Incoming tables are buffered until row_group_size rows are available, so every row group
+    has the same size no matter how small the tables handed to write() are.
+    Shards are written under a temporary name and renamed once closed; on_shard_closed is then
+    called with the shard's file name and the tags passed to write() for the rows it contains.
+    """
+
+    def __init__(self, output_dir: str, schema: pa.Schema, target_shard_bytes: int, row_group_size: int,
+                 compression: str = 'zstd', compression_level: Optional[int] = None,
+                 dictionary_columns: Optional[List[str]] = None,
+                 on_shard_closed: Optional[Callable[[str, list], None]] = None):
+        self.output_dir = output_dir
+        self.schema = schema
+        self.target_shard_bytes = target_shard_bytes
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.compression_level = compression_level
+        self.dictionary_columns = dictionary_columns or []
+        self.on_shard_closed = on_shard_closed
+        self._writer = None
+        self._file_name = None
+        self._tags = []
+        self._buffer = []
+        self._buffered_rows = 0
+
+    def write(self, table: pa.Table, shard_name: str, tag=None) -> None:
+        """
+        Adds a table to the current shard. shard_name is used for the file name if this table
+        starts a new shard, and tag is handed back through on_shard_closed.
+        """
+        if self._writer is None:
+            self._open(shard_name)
+        self._tags.append(tag)
+        self._buffer.append(table.cast(self.schema))
+        self._buffered_rows += table.num_rows
+        while self._buffered_rows >= self.row_group_size:
+            self._flush_row_group(self.row_group_size)
+            if os.path.getsize(self._tmp_path) >= self.target_shard_bytes:
+                self._close_shard()
+                break
+
+    def close(self) -> None:
+        """
+        Writes out any buffered rows and closes the current shard.
+        """
+        if self._writer is not None:
+            self._close_shard()
+
+    def _open(self, shard_name: str) -> None:
+        self._file_name = f'{shard_name}.parquet'
+        self._tmp_path = os.path.join(self.output_dir, self._file_name + '.tmp')
+        self._writer = pq.ParquetWriter(self._tmp_path, self.schema, compression=self.compression,
+                                        compression_level=self.compression_level,
+                                        use_dictionary=self.dictionary_columns)
+
+    def _flush_row_group(self, num_rows: int) -> None:
+        table = pa.concat_tables(self._buffer)
+        self._writer.write_table(table.slice(0, num_rows), row_group_size=num_rows)
+        rest = table.slice(num_rows)
+        self._buffer = [rest] if rest.num_rows else []
+        self._buffered_rows = rest.num_rows
+
+    def _close_shard(self) -> None:
+        # Rows still buffered belong to tables tagged on this shard, so they are written here
+        # too rather than carried over into the next one
+        while self._buffered_rows:
+            self._flush_row_group(min(self._buffered_rows, self.row_group_size))
+        self._writer.close()
+        os.replace(self._tmp_path, os.path.join(self.output_dir, self._file_name))
+        if self.on_shard_closed is not None:
+            self.on_shard_closed(self._file_name, self._tags)
+        self._writer = None
+        self._tags = []
@@ -0,0 +1,73 @@
+import io
+import struct
+import numpy as np
+from itertools import chain, repeat
+from typing import Iterable, List, Sequence
+
+# Signature, flags and header extension length that start every COPY ... (FORMAT BINARY) stream
+COPY_HEADER = b'PGCOPY\n\xff\r\n\x00' + struct.pack('>ii', 0, 0)
+# Field count of -1 that ends the stream
+COPY_TRAILER = struct.pack('>h', -1)
+
+
+def _split_rows(array: np.ndarray) -> List[bytes]:
+    """
+    Returns the bytes of every row of a structured array, whose fields already are in network byte order.
+    """
+    data = array.tobytes()
+    size = array.dtype.itemsize
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+def encode_int4(values: Sequence[int]) -> List[bytes]:
+    fields = np.empty(len(values), dtype=[('length', '>i4'), ('value', '>i4')])
+    fields['length'] = 4
+    fields['value'] = values
+    return _split_rows(fields)
+
+
+def encode_int8(values: Sequence[int]) -> List[bytes]:
+    fields = np.empty(len(values), dtype=[('length', '>i4'), ('value', '>i8')])
+    fields['length'] = 8
+    fields['value'] = values
+    return _split_rows(fields)
+
+
+def encode_bytea(values: Iterable[bytes]) -> List[bytes]:
+    return [struct.pack('>i', len(value)) + value for value in values]
+
+
+def encode_text(values: Iterable[str]) -> List[bytes]:
+    return encode_bytea(value.encode('utf-8') for value in values)
+
+
+def encode_vector(embeddings: np.ndarray) -> List[bytes]:
+    """
+    Encodes the rows of an embedding matrix in pgvector's binary format: the dimension and an unused
+    int16, then the values as big-endian float4.
+    """
+    dimension = embeddings.shape[1]
+    fields = np.empty(len(embeddings), dtype=[('length', '>i4'), ('dimension', '>i2'), ('unused', '>i2'),
+                                              ('values', '>f4', (dimension,))])
+    fields['length'] = 4 + 4 * dimension
+    fields['dimension'] = dimension
+    fields['unused'] = 0
+    fields['values'] = embeddings
+    return _split_rows(fields)
+
+
+def encode_copy_data(columns: List[List[bytes]]) -> bytes:
+    """
+    Returns a COPY binary stream of the rows made of the given encoded columns, all of the same length.
+    """
+    field_count = struct.pack('>h', len(columns))
+    return COPY_HEADER + b''.join(chain.from_iterable(zip(repeat(field_count), *columns))) + COPY_TRAILER
+
+
+def copy_rows(cursor, table: str, column_names: List[str], columns: List[List[bytes]]) -> None:
+    """
+    Loads encoded columns into a table with COPY ... FROM STDIN (FORMAT BINARY). Unlike INSERT, the server
+    doesn't parse any SQL or text per row.
+    """
+    cursor.copy_expert(f"COPY {table} ({', '.join(column_names)}) FROM STDIN (FORMAT BINARY)",
+                       io.BytesIO(encode_copy_data(columns)))
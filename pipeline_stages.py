@@ -0,0 +1,58 @@
+import queue
+import threading
+from typing import Iterable, Iterator, NamedTuple
+
+# Seconds a stage blocked on a full queue waits before checking whether its consumer has stopped
+POLL_INTERVAL = 0.1
+
+
+class _Failure(NamedTuple):
+    error: BaseException
+
+
+_END = object()
+
+
+def iter_in_background(items: Iterable, queue_size: int, name: str) -> Iterator:
+    """
+    Iterates items in a background thread, which runs at most queue_size items ahead of the consumer.
+    Chaining calls, e.g. iter_in_background(map(encode, iter_in_background(read(), ...)), ...), makes
+    a pipeline whose stages work on successive items at the same time, each in its own thread.
+    An exception raised by a stage is raised again in the consumer, and a consumer that stops early
+    stops the stages feeding it.
+    """
+    results = queue.Queue(maxsize=queue_size)
+    stopped = threading.Event()
+
+    def _put(item) -> bool:
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _run() -> None:
+        try:
+            for item in items:
+                if not _put(item):
+                    return
+        except BaseException as error:
+            _put(_Failure(error))
+            return
+        _put(_END)
+
+    thread = threading.Thread(target=_run, name=name, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = results.get()
+            if item is _END:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            yield item
+    finally:
+        stopped.set()
+        thread.join()
@@ -3,11 +3,12 @@ import sys
 from pgvector.psycopg2 import register_vector
 import psycopg2.extras
 import psycopg2
-from sentence_transformers import SentenceTransformer
+from encoders import load_encoder
+from vector_index import get_distance_operator, set_search_options
 
-# Initialize the transformer model
-model = SentenceTransformer('multi-qa-MiniLM-L6-cos-v1', device='cuda')
-model.max_seq_length = 512
+# Initialize the encoder configured in encoders.py, the one the chunks were encoded with.
+# Queries are one-offs, so they skip the embedding cache and the worker pool
+encoder = load_encoder(cache_path=None, num_workers=1)
 
 # Check if the query is provided as a command-line argument
 if len(sys.argv) < 2:
@@ -16,7 +17,7 @@ if len(sys.argv) < 2:
 
 query = sys.argv[1]  # Get the query from command-line argument
 
-embedding = model.encode(query)
+embedding = encoder.encode([query])[0]
 
 # Set up connection parameters
 db_connection_params = {
@@ -35,10 +36,28 @@ register_vector(db_connection)
 # Create a cursor object
 cursor = db_connection.cursor()
 
+# Recall/speed trade-off of the ANN index configured in vector_index.py
+set_search_options(cursor)
+
 # Get NN to embedding
 # cursor.execute('SELECT * FROM wikipedia ORDER BY embedding <-> %s LIMIT 5', (embedding,))
-cursor.execute(
-    'SELECT chunk FROM wikipedia ORDER BY embedding <-> %s LIMIT 5', (embedding,))
+# Chunks with the same text share one embedding, so find the nearest embeddings first and
+# then return one of the chunks pointing to each. Ordering by the operator of the index's distance
+# (cosine by default) lets the ANN index answer instead of a scan of every embedding
+operator = get_distance_operator()
+cursor.execute(f'''
+    SELECT w.chunk
+    FROM (
+        SELECT chunk_hash, embedding {operator} %(embedding)s AS distance
+        FROM wikipedia_embeddings
+        ORDER BY embedding {operator} %(embedding)s
+        LIMIT 5
+    ) AS e
+    CROSS JOIN LATERAL (
+        SELECT chunk FROM wikipedia WHERE embedding_hash = e.chunk_hash LIMIT 1
+    ) AS w
+    ORDER BY e.distance
+''', {'embedding': embedding})
 rows = cursor.fetchall()
 
 for row in rows:
@@ -1,10 +1,28 @@
 CREATE EXTENSION IF NOT EXISTS vector;
 
--- DROP TABLE IF EXISTS wikipedia 
+-- DROP TABLE IF EXISTS wikipedia, wikipedia_embeddings
+
+-- One row per distinct chunk text (sha256 of the normalized text) with its embedding.
+-- The dimension is the encoder's, 384 for multi-qa-MiniLM-L6-cos-v1; create-wiki-vdb-2.0.py sets it from the model
+CREATE TABLE IF NOT EXISTS wikipedia_embeddings (
+	chunk_hash BYTEA PRIMARY KEY,
+	embedding VECTOR(384) NOT NULL
+);
 
 CREATE TABLE IF NOT EXISTS wikipedia (
 	id SERIAL PRIMARY KEY,
+	page_id INTEGER NOT NULL,
+	revision BIGINT NOT NULL,
 	title TEXT NOT NULL,
 	chunk TEXT NOT NULL,
-	embedding VECTOR NOT NULL
-)
+	embedding_hash BYTEA NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS wikipedia_page_id_idx ON wikipedia (page_id);
+CREATE INDEX IF NOT EXISTS wikipedia_embedding_hash_idx ON wikipedia (embedding_hash);
+
+-- ANN index with the cosine operator class, for the normalized MiniLM embeddings. Faster to build once the
+-- rows are loaded; create-wiki-vdb-2.0.py and create-vector-index.py build it with the settings in vector_index.py
+-- SET maintenance_work_mem = '2GB';
+-- CREATE INDEX IF NOT EXISTS wikipedia_embeddings_embedding_idx ON wikipedia_embeddings
+-- 	USING hnsw (embedding vector_cosine_ops) WITH (m = 16, ef_construction = 64);
@@ -0,0 +1,49 @@
+import os
+import argparse
+import pyarrow.parquet as pq
+from typing import List, Tuple
+
+
+def add_shard_arguments(parser: argparse.ArgumentParser) -> None:
+    """
+    Adds the --shard and --num-shards options shared by the extraction and embedding stages.
+    """
+    parser.add_argument('--shard', type=int, default=0,
+                        help="index of the shard this machine processes, from 0 to --num-shards - 1")
+    parser.add_argument('--num-shards', type=int, default=1,
+                        help="total number of machines the work is split across")
+
+
+def check_shard_arguments(parser: argparse.ArgumentParser, args: argparse.Namespace) -> None:
+    if args.num_shards < 1 or not 0 <= args.shard < args.num_shards:
+        parser.error("--shard must be between 0 and --num-shards - 1")
+
+
+def select_shard(items: List, shard: int, num_shards: int) -> List:
+    """
+    Returns the items owned by a shard. Items are dealt out round-robin, so as long as every
+    machine lists them in the same order, the shards are disjoint, cover every item and are
+    balanced, without any coordination between machines.
+    """
+    return items[shard::num_shards]
+
+
+def get_shard_suffix(shard: int, num_shards: int) -> str:
+    """
+    Returns the suffix that keeps the per-shard files of a stage apart, or '' for an unsharded run.
+    """
+    return f'-shard{shard:03d}-of-{num_shards:03d}' if num_shards > 1 else ''
+
+
+def list_row_groups(parquet_dir: str) -> List[Tuple[str, int]]:
+    """
+    Returns (file path, row group) for every row group of the Parquet files in parquet_dir,
+    in a fixed order: files sorted by name, row groups in file order.
+    """
+    row_groups = []
+    for file_name in sorted(os.listdir(parquet_dir)):
+        if file_name.endswith('.parquet'):
+            file_path = os.path.join(parquet_dir, file_name)
+            num_row_groups = pq.ParquetFile(file_path).num_row_groups
+            row_groups.extend((file_path, i) for i in range(num_row_groups))
+    return row_groups
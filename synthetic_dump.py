@@ -0,0 +1,247 @@
+import os
+import bz2
+import random
+import hashlib
+import argparse
+import itertools
+import lxml.etree as etree
+from xml.sax.saxutils import escape
+from typing import List, Optional, Tuple
+
+# Fixture the 'fixture' source recycles pages from
+FIXTURE_PATH = 'wikipedia-cleaning/test_data.xml'
+
+# Real dumps put 100 pages in every bz2 stream
+PAGES_PER_STREAM = 100
+
+SITEINFO_HEADER = """<mediawiki xmlns="http://www.mediawiki.org/xml/export-0.10/" version="0.10" xml:lang="en">
+  <siteinfo>
+    <sitename>Wikipedia</sitename>
+    <dbname>enwiki</dbname>
+    <base>https://en.wikipedia.org/wiki/Main_Page</base>
+    <generator>synthetic_dump.py</generator>
+    <case>first-letter</case>
+  </siteinfo>
+"""
+FOOTER = "</mediawiki>\n"
+
+PAGE_TEMPLATE = """  <page>
+    <title>{title}</title>
+    <ns>{ns}</ns>
+    <id>{page_id}</id>{redirect}
+    <revision>
+      <id>{revision_id}</id>
+      <timestamp>2023-03-01T00:00:00Z</timestamp>
+      <model>wikitext</model>
+      <format>text/x-wiki</format>
+      <text bytes="{num_bytes}" xml:space="preserve">{text}</text>
+      <sha1>{sha1}</sha1>
+    </revision>
+  </page>
+"""
+
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+
+
+def get_sha1(text: str) -> str:
+    """
+    Returns the sha1 of a revision's text in base 36, the way MediaWiki dumps store it.
+    """
+    number = int(hashlib.sha1(text.encode('utf-8')).hexdigest(), 16)
+    digits = []
+    while number:
+        number, digit = divmod(number, 36)
+        digits.append(BASE36_DIGITS[digit])
+    return ''.join(reversed(digits)).rjust(31, '0')
+
+
+def render_page(page_id: int, title: str, text: str, redirect: Optional[str] = None, ns: int = 0) -> str:
+    """
+    Returns the XML of one page, with a revision id derived from the page id.
+    """
+    return PAGE_TEMPLATE.format(
+        title=escape(title), ns=ns, page_id=page_id,
+        redirect=f'\n    <redirect title="{escape(redirect, {chr(34): "&quot;"})}" />' if redirect else '',
+        revision_id=1_000_000_000 + page_id, num_bytes=len(text.encode('utf-8')),
+        text=escape(text), sha1=get_sha1(text))
+
+
+def load_fixture_pages(xml_path: str) -> List[Tuple[str, str, Optional[str]]]:
+    """
+    Returns (title, wikitext, redirect target or None) for every main-namespace page of a MediaWiki XML file.
+    """
+    pages = []
+    for _, page in etree.iterparse(xml_path, tag='{*}page'):
+        if page.findtext('{*}ns') == '0':
+            redirect = page.find('{*}redirect')
+            pages.append((page.findtext('{*}title'), page.findtext('{*}revision/{*}text') or '',
+                          redirect.get('title') if redirect is not None else None))
+        page.clear()
+    return pages
+
+
+class RandomWikitext:
+    """
+    Generates article wikitext with the markup mix of real articles: an infobox, bold lead, links with and
+    without labels, references with citation templates, headings, bullet lists, the odd table and
+    categories. Words are drawn from a Zipf-like vocabulary, and article lengths from a log-normal
+    distribution, so a few long articles dominate the bytes like in a real dump.
+    """
+
+    def __init__(self, rng: random.Random, vocabulary_size: int = 20_000):
+        self.rng = rng
+        self.vocabulary = [''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(2, 11)))
+                           for _ in range(vocabulary_size)]
+        self.cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(vocabulary_size)))
+
+    def words(self, count: int) -> List[str]:
+        return self.rng.choices(self.vocabulary, cum_weights=self.cum_weights, k=count)
+
+    def title(self) -> str:
+        return ' '.join(self.words(self.rng.randint(1, 4))).capitalize()
+
+    def sentence(self) -> str:
+        words = self.words(self.rng.randint(6, 30))
+        for i in range(len(words)):
+            roll = self.rng.random()
+            if roll < 0.06:
+                words[i] = f'[[{words[i].capitalize()}]]'
+            elif roll < 0.09:
+                words[i] = f'[[{self.title()}|{words[i]}]]'
+            elif roll < 0.10:
+                words[i] = f"''{words[i]}''"
+        sentence = ' '.join(words).capitalize() + '.'
+        if self.rng.random() < 0.2:
+            sentence += ('<ref>{{cite web |url=https://example.org/' + self.words(1)[0] +
+                         ' |title=' + self.title() + ' |access-date=2023-01-01}}</ref>')
+        return sentence
+
+    def paragraph(self) -> str:
+        return ' '.join(self.sentence() for _ in range(self.rng.randint(2, 8)))
+
+    def article(self, title: str) -> str:
+        lines = ['{{Infobox ' + self.words(1)[0] + '\n| name = ' + title + '\n| founded = {{start date|1900}}\n}}',
+                 f"'''{title}''' is " + self.paragraph()]
+        for _ in range(max(1, int(self.rng.lognormvariate(1.0, 0.9)))):
+            lines.append(f'\n== {self.title()} ==')
+            for _ in range(self.rng.randint(1, 4)):
+                lines.append(self.paragraph())
+                lines.append('')
+            if self.rng.random() < 0.3:
+                lines.extend(f'* {self.sentence()}' for _ in range(self.rng.randint(2, 6)))
+            if self.rng.random() < 0.1:
+                rows = '\n|-\n'.join(' || '.join(self.words(3)) for _ in range(self.rng.randint(2, 5)))
+                lines.append('{| class="wikitable"\n! ' + ' !! '.join(self.words(3)) + '\n|-\n| ' + rows + '\n|}')
+        lines.append('\n== References ==\n{{reflist}}')
+        lines.extend(f'[[Category:{self.title()}]]' for _ in range(self.rng.randint(1, 4)))
+        return '\n'.join(lines)
+
+
+def generate_pages(num_pages: int, source: str, seed: int, redirect_fraction: float,
+                   fixture_path: str = FIXTURE_PATH):
+    """
+    Yields (title, wikitext, redirect target or None) for num_pages pages.
+    The 'fixture' source cycles through the pages of the fixture, making every title unique;
+    the 'random' source generates articles, with redirect_fraction of the pages being redirects.
+    """
+    rng = random.Random(seed)
+    if source == 'fixture':
+        fixture_pages = load_fixture_pages(fixture_path)
+        for i in range(num_pages):
+            title, text, redirect = fixture_pages[i % len(fixture_pages)]
+            copy = i // len(fixture_pages)
+            yield (f'{title} ({copy})' if copy else title), text, redirect
+        return
+
+    wikitext = RandomWikitext(rng)
+    titles = []
+    for i in range(num_pages):
+        title = f'{wikitext.title()} {i}'
+        if titles and rng.random() < redirect_fraction:
+            target = rng.choice(titles)
+            yield title, f'#REDIRECT [[{target}]]', target
+        else:
+            titles.append(title)
+            yield title, wikitext.article(title), None
+
+
+def get_part_names(prefix: str, part: Optional[int], first_page: int, last_page: int) -> Tuple[str, str]:
+    """
+    Returns the names of a part's bz2 file and index, numbered like split dumps when part is given.
+    """
+    if part is None:
+        return (f'{prefix}-pages-articles-multistream.xml.bz2',
+                f'{prefix}-pages-articles-multistream-index.txt.bz2')
+    page_range = f'-p{first_page}p{last_page}'
+    return (f'{prefix}-pages-articles-multistream{part}.xml{page_range}.bz2',
+            f'{prefix}-pages-articles-multistream-index{part}.txt{page_range}.bz2')
+
+
+def write_part(output_dir: str, names: Tuple[str, str], pages: List[Tuple[int, str, str, Optional[str]]],
+               pages_per_stream: int) -> None:
+    """
+    Writes one multistream part: the site info in the first stream, pages_per_stream pages in every
+    following stream and the closing tag in the last one, plus the offset:page_id:title index.
+    """
+    article_name, index_name = names
+    index_lines = []
+    with open(os.path.join(output_dir, article_name), 'wb') as f:
+        f.write(bz2.compress(SITEINFO_HEADER.encode('utf-8')))
+        for i in range(0, len(pages), pages_per_stream):
+            offset = f.tell()
+            stream = []
+            for page_id, title, text, redirect in pages[i:i + pages_per_stream]:
+                stream.append(render_page(page_id, title, text, redirect))
+                index_lines.append(f'{offset}:{page_id}:{title}\n')
+            f.write(bz2.compress(''.join(stream).encode('utf-8')))
+        f.write(bz2.compress(FOOTER.encode('utf-8')))
+    with open(os.path.join(output_dir, index_name), 'wb') as f:
+        f.write(bz2.compress(''.join(index_lines).encode('utf-8')))
+
+
+def generate_dump(output_dir: str, num_pages: int, prefix: str = 'enwiki-20230301', num_parts: int = 1,
+                  pages_per_stream: int = PAGES_PER_STREAM, source: str = 'random', seed: int = 0,
+                  redirect_fraction: float = 0.3, fixture_path: str = FIXTURE_PATH) -> List[str]:
+    """
+    Writes a synthetic multistream dump of num_pages pages to output_dir, laid out like a real one:
+    a single pages-articles-multistream.xml.bz2 file, or num_parts numbered parts with page ranges in
+    their names. The same arguments always produce the same files. Returns the bz2 file names.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    pages = [(page_id, title, text, redirect) for page_id, (title, text, redirect) in
+             enumerate(generate_pages(num_pages, source, seed, redirect_fraction, fixture_path), start=1)]
+    pages_per_part = -(-len(pages) // num_parts)
+    article_names = []
+    for part in range(num_parts):
+        part_pages = pages[part * pages_per_part:(part + 1) * pages_per_part]
+        if not part_pages:
+            break
+        names = get_part_names(prefix, part + 1 if num_parts > 1 else None, part_pages[0][0], part_pages[-1][0])
+        write_part(output_dir, names, part_pages, pages_per_stream)
+        article_names.append(names[0])
+    return article_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a synthetic Wikipedia multistream dump for benchmarks.")
+    parser.add_argument('output_dir')
+    parser.add_argument('--pages', type=int, default=10_000, help="number of pages")
+    parser.add_argument('--parts', type=int, default=1, help="number of numbered dump parts")
+    parser.add_argument('--pages-per-stream', type=int, default=PAGES_PER_STREAM)
+    parser.add_argument('--source', choices=['random', 'fixture'], default='random',
+                        help="generate random wikitext, or recycle the pages of " + FIXTURE_PATH)
+    parser.add_argument('--redirect-fraction', type=float, default=0.3)
+    parser.add_argument('--prefix', default='enwiki-20230301')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    article_names = generate_dump(args.output_dir, args.pages, prefix=args.prefix, num_parts=args.parts,
+                                  pages_per_stream=args.pages_per_stream, source=args.source, seed=args.seed,
+                                  redirect_fraction=args.redirect_fraction)
+    for article_name in article_names:
+        size = os.path.getsize(os.path.join(args.output_dir, article_name))
+        print(f"Wrote {article_name} ({size / 1024 / 1024:.1f} MiB)")
+
+
+if __name__ == '__main__':
+    main()
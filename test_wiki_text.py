@@ -0,0 +1,17 @@
+from wiki_text import split_text_into_chunks
+
+
+def make_paragraph(num_words: int, prefix: str) -> str:
+    return ' '.join(f'{prefix}{i}' for i in range(num_words))
+
+
+def test_overlap_across_split_paragraph():
+    text = '\n'.join([make_paragraph(5, 'a'), make_paragraph(400, 'b'), make_paragraph(95, 'c')])
+    chunks = [chunk.split() for chunk in split_text_into_chunks(text, max_tokens=100, overlap=10)]
+
+    assert all(len(chunk) <= 100 for chunk in chunks)
+    for previous, chunk in zip(chunks, chunks[1:]):
+        assert chunk[:10] == previous[-10:]
+    # Dropping the overlap of each chunk gives back the text
+    words = chunks[0] + [word for chunk in chunks[1:] for word in chunk[10:]]
+    assert words == text.split()
@@ -0,0 +1,112 @@
+import os
+import time
+from typing import Optional, Tuple
+
+# Approximate nearest neighbour index on the embeddings: 'hnsw', 'ivfflat' or 'none' for exact
+# sequential scans. HNSW answers queries faster at the same recall and can be built on an empty table,
+# IVFFlat builds faster and smaller but needs the rows to be loaded first to pick its lists
+VECTOR_INDEX = os.environ.get('VECTOR_INDEX', 'hnsw')
+VECTOR_INDEX_METHODS = ('hnsw', 'ivfflat', 'none')
+
+# The MiniLM models are trained for cosine similarity and their embeddings are normalized, so the index
+# uses the cosine operator class, and queries must order by the matching operator for it to be used
+VECTOR_DISTANCE = os.environ.get('VECTOR_DISTANCE', 'cosine')
+# Operator class and operator of each distance
+VECTOR_DISTANCES = {
+    'cosine': ('vector_cosine_ops', '<=>'),
+    'l2': ('vector_l2_ops', '<->'),
+    'inner_product': ('vector_ip_ops', '<#>'),
+}
+
+# HNSW build settings: links per node, and size of the candidate list while inserting. Higher values
+# give a better recall for a slower build and a larger index
+HNSW_M = int(os.environ.get('HNSW_M', 16))
+HNSW_EF_CONSTRUCTION = int(os.environ.get('HNSW_EF_CONSTRUCTION', 64))
+# Size of the candidate list of an HNSW query, at least the number of results asked for
+HNSW_EF_SEARCH = int(os.environ.get('HNSW_EF_SEARCH', 40))
+
+# IVFFlat lists, by default rows / 1000 up to a million rows and sqrt(rows) above, as pgvector suggests
+IVFFLAT_LISTS = int(os.environ['IVFFLAT_LISTS']) if os.environ.get('IVFFLAT_LISTS') else None
+# Lists an IVFFlat query searches; sqrt(lists) is a good start
+IVFFLAT_PROBES = int(os.environ.get('IVFFLAT_PROBES', 10))
+
+
+def get_distance_operator(distance: str = VECTOR_DISTANCE) -> str:
+    return VECTOR_DISTANCES[distance][1]
+
+
+def get_vector_index_name(table: str) -> str:
+    return f'{table}_embedding_idx'
+
+
+def get_ivfflat_lists(num_rows: int) -> int:
+    if num_rows <= 1_000_000:
+        return max(num_rows // 1000, 1)
+    return int(num_rows ** 0.5)
+
+
+def check_vector_dimension(cursor, table: str, dimension: int) -> None:
+    """
+    Raises a ValueError if the embedding column of an existing table was declared with another dimension
+    than the encoder's, e.g. by a run with another model. A column without a dimension can't be indexed.
+    """
+    cursor.execute("""
+       SELECT atttypmod FROM pg_attribute WHERE attrelid = %s::regclass AND attname = 'embedding'
+    """, (table,))
+    declared = cursor.fetchone()[0]
+    if declared != dimension:
+        raise ValueError(f"{table}.embedding is declared as vector({declared if declared > 0 else ''}), "
+                         f"the encoder's embeddings have {dimension} dimensions; drop the tables or "
+                         f"ALTER the column to vector({dimension})")
+
+
+def get_vector_index_size(cursor, table: str) -> Optional[int]:
+    """
+    Returns the size in bytes of the table's vector index, or None if it has none.
+    """
+    cursor.execute("SELECT pg_relation_size(to_regclass(%s))", (get_vector_index_name(table),))
+    return cursor.fetchone()[0]
+
+
+def create_vector_index(cursor, table: str, method: str = VECTOR_INDEX, distance: str = VECTOR_DISTANCE,
+                        m: int = HNSW_M, ef_construction: int = HNSW_EF_CONSTRUCTION,
+                        lists: Optional[int] = IVFFLAT_LISTS, replace: bool = False) -> Optional[Tuple[float, int]]:
+    """
+    Builds the HNSW or IVFFlat index on the embedding column of table, unless it already has one and
+    replace isn't set. Returns the build time in seconds and the size of the index in bytes, or None
+    if nothing was built. Set maintenance_work_mem first: an HNSW build is much faster while the graph
+    fits in it.
+    """
+    if method == 'none':
+        return None
+    name = get_vector_index_name(table)
+    if replace:
+        cursor.execute(f"DROP INDEX IF EXISTS {name}")
+    elif get_vector_index_size(cursor, table) is not None:
+        return None
+
+    opclass = VECTOR_DISTANCES[distance][0]
+    if method == 'hnsw':
+        options = f'm = {int(m)}, ef_construction = {int(ef_construction)}'
+    else:
+        if lists is None:
+            cursor.execute(f"SELECT count(*) FROM {table}")
+            lists = get_ivfflat_lists(cursor.fetchone()[0])
+        options = f'lists = {int(lists)}'
+    start_time = time.perf_counter()
+    cursor.execute(f"CREATE INDEX {name} ON {table} USING {method} (embedding {opclass}) WITH ({options})")
+    build_time = time.perf_counter() - start_time
+    size = get_vector_index_size(cursor, table)
+    print(f"{method} index {name} ({options}) built in {build_time:.1f} seconds, {size / 2 ** 20:.1f} MiB")
+    return build_time, size
+
+
+def set_search_options(cursor, method: str = VECTOR_INDEX, ef_search: int = HNSW_EF_SEARCH,
+                       probes: int = IVFFLAT_PROBES) -> None:
+    """
+    Sets the recall/speed trade-off of the index's queries for the session.
+    """
+    if method == 'hnsw':
+        cursor.execute("SET hnsw.ef_search = %s", (ef_search,))
+    elif method == 'ivfflat':
+        cursor.execute("SET ivfflat.probes = %s", (probes,))
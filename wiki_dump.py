@@ -0,0 +1,235 @@
+import os
+import re
+import bz2
+import mmap
+import numpy as np
+import pandas as pd
+import lxml.etree as etree
+from array import array
+from bz2 import BZ2Decompressor
+from tqdm import tqdm
+from typing import List, NamedTuple, Tuple
+
+
+# Matches both split dumps (multistream1.xml-p1p41242.bz2) and single-file ones (multistream.xml.bz2)
+DUMP_PART_RE = re.compile(r'^(?P<prefix>.+)-pages-articles-multistream(?P<part>\d*)\.xml(?P<range>-p\d+p\d+)?\.bz2$')
+
+
+class DumpPart(NamedTuple):
+    """
+    One multistream bz2 file of a dump, together with its index and the directory its .npy index is cached in.
+    """
+    name: str
+    article_path: str
+    index_path: str
+    index_cache_path: str
+
+
+def find_dump_parts(dump_dir: str, prefix: str) -> List[DumpPart]:
+    """
+    Returns every multistream part in dump_dir whose file name starts with prefix (e.g. 'enwiki-20230301')
+    and has a matching index file, in part order. If numbered parts are present, the single-file
+    dump holding the same pages is left out.
+    """
+    parts = []
+    for file_name in os.listdir(dump_dir):
+        match = DUMP_PART_RE.match(file_name)
+        if match is None or not file_name.startswith(prefix):
+            continue
+        part, page_range = match.group('part'), match.group('range') or ''
+        index_name = f"{match.group('prefix')}-pages-articles-multistream-index{part}.txt{page_range}.bz2"
+        if not os.path.isfile(os.path.join(dump_dir, index_name)):
+            print(f"Skipping {file_name}: index file {index_name} not found")
+            continue
+        cache_name = f"{match.group('prefix')}-pages-articles-multistream-index{part}{page_range}/"
+        first_page = int(page_range[2:].split('p')[0]) if page_range else 0
+        parts.append(((int(part) if part else 0, first_page), DumpPart(
+            f'multistream{part}{page_range}', os.path.join(dump_dir, file_name),
+            os.path.join(dump_dir, index_name), os.path.join(dump_dir, cache_name))))
+
+    if any(order[0] > 0 for order, _ in parts):
+        parts = [(order, part) for order, part in parts if order[0] > 0]
+    return [part for _, part in sorted(parts)]
+
+
+class OffsetIndex(NamedTuple):
+    """
+    Memory-mapped view of a multistream index. The stream arrays have one entry per bz2 stream,
+    the page arrays one entry per page, sorted by page id.
+    """
+    stream_offsets: np.ndarray
+    stream_sizes: np.ndarray
+    page_ids: np.ndarray
+    page_streams: np.ndarray
+
+
+def build_offset_index(index_path: str, article_path: str, index_dir: str) -> None:
+    """
+    Decompresses and parses the multistream index line by line, and saves the stream offsets,
+    stream sizes and page ids as .npy files in index_dir.
+    """
+    stream_offsets = array('q')
+    page_ids = array('q')
+    page_streams = array('q')
+    last_offset = None
+    with bz2.open(index_path, 'rb') as f:
+        for line in tqdm(f, desc="Processing Article Offsets", unit=" pages"):
+            offset, page_id, _ = line.split(b':', 2)
+            if last_offset != offset:
+                last_offset = offset
+                stream_offsets.append(int(offset))
+            page_ids.append(int(page_id))
+            page_streams.append(len(stream_offsets) - 1)
+
+    stream_offsets = np.frombuffer(stream_offsets, dtype=np.int64)
+    # The last stream runs to the end of the file; the trailing </mediawiki> stream is
+    # ignored by the decompressor, which stops at the end of the first bz2 stream
+    stream_sizes = np.diff(stream_offsets, append=os.path.getsize(article_path))
+    page_ids = np.frombuffer(page_ids, dtype=np.int64)
+    order = np.argsort(page_ids, kind='stable')
+
+    os.makedirs(index_dir, exist_ok=True)
+    arrays = {
+        'stream_offsets': stream_offsets,
+        'stream_sizes': stream_sizes,
+        'page_ids': page_ids[order],
+        'page_streams': np.frombuffer(page_streams, dtype=np.int64)[order].astype(np.int32),
+    }
+    for name, values in arrays.items():
+        # Write to a temporary file first, so an interrupted build never leaves a truncated array
+        tmp_path = os.path.join(index_dir, f'{name}.tmp.npy')
+        np.save(tmp_path, values)
+        os.replace(tmp_path, os.path.join(index_dir, f'{name}.npy'))
+
+
+def load_offset_index(index_path: str, article_path: str, index_dir: str) -> OffsetIndex:
+    """
+    Returns the offset index of the bz2 file, memory-mapped from the .npy files in index_dir.
+    The .npy files are built from the original index file the first time this is called.
+    """
+    if not all(os.path.isfile(os.path.join(index_dir, f'{name}.npy')) for name in OffsetIndex._fields):
+        build_offset_index(index_path, article_path, index_dir)
+
+    return OffsetIndex(*(np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+                         for name in OffsetIndex._fields))
+
+
+def get_stream_ranges(index: OffsetIndex) -> List[Tuple[int, int]]:
+    """
+    Returns the (start, end) byte range of every stream within the bz2 file.
+    """
+    starts = index.stream_offsets.tolist()
+    ends = (index.stream_offsets + index.stream_sizes).tolist()
+    return list(zip(starts, ends))
+
+
+def find_page_stream(index: OffsetIndex, page_id: int) -> Tuple[int, int]:
+    """
+    Returns the (start, end) byte range of the stream that contains the given page,
+    using a binary search over the sorted page ids.
+    """
+    position = int(np.searchsorted(index.page_ids, page_id))
+    if position == len(index.page_ids) or index.page_ids[position] != page_id:
+        raise KeyError(f"Page {page_id} is not in the index")
+    stream = int(index.page_streams[position])
+    start = int(index.stream_offsets[stream])
+    return start, start + int(index.stream_sizes[stream])
+
+
+def open_dump(article_path: str) -> mmap.mmap:
+    """
+    Memory-maps the bz2 file read-only, so each stream can be sliced out without reading
+    any of the bytes before it.
+    """
+    with open(article_path, 'rb') as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_stream(dump: mmap.mmap, start: int, end: int) -> bytes:
+    """
+    Returns the compressed bytes of the single bz2 stream between start and end.
+    """
+    return dump[start:end]
+
+
+class PageTarget:
+    """
+    lxml parser target that collects the id, title, text, revision id and sha1 of article pages as the parser
+    emits events, without building an element tree. Pages with a <redirect> or a non-zero <ns>
+    are marked as skipped as soon as those elements end, and the text of skipped pages is
+    never accumulated.
+    """
+
+    def __init__(self):
+        self.ids = []
+        self.titles = []
+        self.articles = []
+        self.revisions = []
+        self.sha1s = []
+        self._path = []
+        self._data = []
+        self._page = None
+
+    def start(self, tag, attrib):
+        self._path.append(tag)
+        if tag == 'page':
+            self._page = {'skip': False}
+        elif tag == 'redirect' and self._page is not None:
+            self._page['skip'] = True
+        self._data.clear()
+
+    def data(self, data):
+        if self._page is not None and not self._page['skip']:
+            self._data.append(data)
+
+    def end(self, tag):
+        page = self._page
+        parent = self._path[-2] if len(self._path) > 1 else None
+        if page is not None and not page['skip']:
+            if parent == 'page' and tag == 'ns':
+                page['skip'] = ''.join(self._data).strip() != '0'
+            elif parent == 'page' and tag in ('id', 'title'):
+                page[tag] = ''.join(self._data)
+            elif parent == 'revision' and tag in ('id', 'sha1', 'text'):
+                page['revision_' + tag] = ''.join(self._data)
+        if tag == 'page':
+            if page is not None and not page['skip']:
+                self.ids.append(int(page['id']))
+                self.titles.append(page['title'])
+                self.articles.append(page.get('revision_text', ''))
+                self.revisions.append(int(page['revision_id']))
+                self.sha1s.append(page.get('revision_sha1', ''))
+            self._page = None
+        self._data.clear()
+        self._path.pop()
+
+    def close(self):
+        return self
+
+
+def decompress_stream(byte_string_compressed: bytes) -> bytes:
+    """
+    Decompresses one bz2 stream of the dump into the XML of its pages.
+    """
+    decompressor = BZ2Decompressor()
+    return decompressor.decompress(byte_string_compressed)
+
+
+def parse_pages(byte_string: bytes) -> pd.DataFrame:
+    """
+    Parses the XML of the pages of one stream and returns a pandas DataFrame containing the article ID, title, and text,
+    along with the revision ID and the sha1 of the revision text.
+    Redirects and pages outside the main namespace are dropped while parsing.
+    """
+    target = PageTarget()
+    parser = etree.XMLParser(target=target, huge_tree=True)
+    parser.feed(b'<root>')
+    parser.feed(byte_string)
+    parser.feed(b'</root>')
+    parser.close()
+
+    df = pd.DataFrame({'index': np.array(target.ids, dtype=np.int32),
+                       'title': target.titles, 'article': target.articles,
+                       'revision': np.array(target.revisions, dtype=np.int64), 'sha1': target.sha1s})
+    return df
+
@@ -0,0 +1,278 @@
+import re
+import html
+from typing import List, Optional, Tuple
+import mwparserfromhell
+
+# Markup the fast path doesn't try to reproduce; pages containing it go through mwparserfromhell
+FALLBACK_MARKERS = ('{{{', '<nowiki', '<pre', '<noinclude', '<includeonly', '<onlyinclude')
+
+# Tags whose contents mwparserfromhell drops from stripped text
+INVISIBLE_TAGS = ('categorytree', 'gallery', 'graph', 'imagemap', 'inputbox', 'math', 'score',
+                  'section', 'templatedata', 'timeline')
+
+COMMENT_RE = re.compile(r'<!--.*?-->', re.DOTALL)
+INVISIBLE_TAG_START_RE = re.compile(r'<({})\b'.format('|'.join(INVISIBLE_TAGS)), re.IGNORECASE)
+INVISIBLE_TAG_END_RES = {tag: re.compile(r'</{}\s*>'.format(tag), re.IGNORECASE) for tag in INVISIBLE_TAGS}
+TEMPLATE_TOKEN_RE = re.compile(r'\{\{|\}\}')
+INNER_WIKILINK_RE = re.compile(r'\[\[([^\[\]]*)\]\]')
+EXTERNAL_LINK_RE = re.compile(r'\[(?:https?:|ftp:)?//[^\s\]]+(?:\s+([^\]]*))?\]')
+HTML_TAG_RE = re.compile(r'</?[a-zA-Z][^<>]*?/?>')
+BOLD_ITALIC_RE = re.compile(r"'{2,5}")
+HEADING_RE = re.compile(r'^(={1,6})(.+?)\1[ \t]*$', re.MULTILINE)
+LIST_MARKER_RE = re.compile(r'^[*#:;]+', re.MULTILINE)
+MULTIPLE_NEWLINES_RE = re.compile(r'\n{3,}')
+WORD_RE = re.compile(r'\S+')
+TABLE_CELL_SEPARATOR_RE = re.compile(r'\|\||!!')
+TABLE_CELL_ATTRIBUTES_RE = re.compile(r'^[^|\[\]{}]*=[^|\[\]{}]*\|(?!\|)')
+
+
+def _strip_templates(text: str) -> Optional[str]:
+    """
+    Removes {{...}} templates, including nested ones. Returns None if the braces don't balance.
+    """
+    pieces = []
+    depth = 0
+    position = 0
+    for match in TEMPLATE_TOKEN_RE.finditer(text):
+        if match.group() == '{{':
+            if depth == 0:
+                pieces.append(text[position:match.start()])
+            depth += 1
+        else:
+            if depth == 0:
+                return None
+            depth -= 1
+            if depth == 0:
+                position = match.end()
+    if depth != 0:
+        return None
+    pieces.append(text[position:])
+    return ''.join(pieces)
+
+
+def _strip_invisible_tags(text: str) -> str:
+    """
+    Removes the INVISIBLE_TAGS together with their contents. A tag that is never closed is left in place.
+    Each opening tag gets one search for its closing tag, which the next search starts after, and a tag
+    name found unclosed isn't searched for again, so this runs in linear time.
+    """
+    pieces = []
+    position = 0
+    search_position = 0
+    tag_end = -1
+    unclosed_tags = set()
+    while True:
+        match = INVISIBLE_TAG_START_RE.search(text, search_position)
+        if match is None:
+            break
+        # The first '>' after the previous opening tag is also the first one after this one if it comes later
+        if tag_end < match.end():
+            tag_end = text.find('>', match.end())
+            if tag_end == -1:
+                break
+        end = tag_end
+        if text[end - 1] != '/':
+            tag = match.group(1).lower()
+            closing_match = None if tag in unclosed_tags else INVISIBLE_TAG_END_RES[tag].search(text, end + 1)
+            if closing_match is None:
+                unclosed_tags.add(tag)
+                search_position = match.end()
+                continue
+            end = closing_match.end() - 1
+        pieces.append(text[position:match.start()])
+        position = search_position = end + 1
+    pieces.append(text[position:])
+    return ''.join(pieces)
+
+
+def _strip_tables(text: str) -> Optional[str]:
+    """
+    Replaces {| ... |} tables with the text of their cells, one table per line.
+    Returns None if a table is never closed.
+    """
+    lines = []
+    cells = []
+    depth = 0
+    for line in text.split('\n'):
+        stripped = line.strip()
+        if stripped.startswith('{|'):
+            depth += 1
+            continue
+        if depth == 0:
+            lines.append(line)
+            continue
+        if stripped.startswith('|}'):
+            depth -= 1
+            if depth == 0:
+                lines.append(' '.join(cells))
+                cells = []
+            continue
+        if stripped.startswith('|-'):
+            continue
+        if stripped.startswith('|+') or stripped[:1] in ('|', '!'):
+            stripped = stripped[2:] if stripped.startswith('|+') else stripped[1:]
+            for cell in TABLE_CELL_SEPARATOR_RE.split(stripped):
+                cells.append(TABLE_CELL_ATTRIBUTES_RE.sub('', cell).strip())
+        else:
+            cells.append(stripped)
+    if depth != 0:
+        return None
+    return '\n'.join(lines)
+
+
+def _replace_wikilink(match: re.Match) -> str:
+    target, _, text = match.group(1).partition('|')
+    return text if text else target
+
+
+def strip_wiki_markup(raw_text: str) -> Optional[str]:
+    """
+    Fast regex-based equivalent of mwparserfromhell's strip_code() for the common markup:
+    comments, templates, tables, links, bold and italics, refs and other HTML tags, headings and lists.
+    Returns None for pages it can't handle, so the caller can fall back to mwparserfromhell.
+    """
+    if any(marker in raw_text for marker in FALLBACK_MARKERS):
+        return None
+
+    text = COMMENT_RE.sub('', raw_text)
+    if '<!--' in text:
+        return None
+    text = _strip_invisible_tags(text)
+    text = _strip_templates(text)
+    if text is None:
+        return None
+    text = _strip_tables(text)
+    if text is None:
+        return None
+
+    # Replace the innermost links first, so links inside image captions are resolved before the image
+    while True:
+        text, num_links = INNER_WIKILINK_RE.subn(_replace_wikilink, text)
+        if num_links == 0:
+            break
+    text = EXTERNAL_LINK_RE.sub(lambda match: match.group(1) or '', text)
+    text = HTML_TAG_RE.sub('', text)
+    text = BOLD_ITALIC_RE.sub('', text)
+    text = HEADING_RE.sub(r'\2', text)
+    text = LIST_MARKER_RE.sub('', text)
+    text = html.unescape(text)
+
+    # Collapse blank lines the same way strip_code() does
+    return MULTIPLE_NEWLINES_RE.sub('\n\n', text.strip('\n'))
+
+
+def clean_wiki_text(raw_text, fast=True):
+    # Clean Wikipedia text, using the fast path unless the page needs the full parser
+    intermediate_text = strip_wiki_markup(raw_text) if fast else None
+    if intermediate_text is None:
+        wikicode = mwparserfromhell.parse(raw_text)
+        intermediate_text = wikicode.strip_code()
+
+    # Split text into lines and remove consecutive empty lines, keeping the first (lead) line
+    lines = intermediate_text.split('\n')
+    clean_lines = [line for line, prev_line in zip(
+        lines, [''] + lines) if line.strip() or prev_line.strip()]
+
+    clean_text = '\n'.join(clean_lines)
+    return clean_text
+
+
+def _get_word_spans(text: str) -> List[Tuple[int, int]]:
+    return [match.span() for match in WORD_RE.finditer(text)]
+
+
+def _split_piece(piece: tuple, start_unit: int, end_unit: int) -> tuple:
+    """
+    Returns the part of a (separator, text, num_units, spans) piece between two unit positions.
+    A part that doesn't start the piece is separated by the text between its first unit and the one before,
+    so a cut inside a word doesn't add a space. Word spans are only computed here, for the few pieces
+    that actually need cutting.
+    """
+    separator, text, _, spans = piece
+    spans = spans if spans is not None else _get_word_spans(text)
+    if start_unit > 0:
+        separator = text[spans[start_unit - 1][1]:spans[start_unit][0]]
+    spans = spans[start_unit:end_unit]
+    start = spans[0][0]
+    end = spans[-1][1]
+    return separator, text[start:end], len(spans), [(a - start, b - start) for a, b in spans]
+
+
+def _append_chunk(chunks: List[str], pieces: List[tuple]) -> None:
+    chunk = ''.join(separator + text for separator, text, _, _ in pieces).strip()
+    if chunk:
+        chunks.append(chunk)
+
+
+def _get_tail_pieces(pieces: List[tuple], num_units: int) -> List[tuple]:
+    """
+    Returns the last num_units units of a chunk's pieces, cutting into the first piece it reaches if needed.
+    """
+    tail = []
+    for piece in reversed(pieces):
+        if num_units <= 0:
+            break
+        if piece[2] > num_units:
+            piece = _split_piece(piece, piece[2] - num_units, piece[2])
+        tail.append(piece)
+        num_units -= piece[2]
+    return tail[::-1]
+
+
+def split_text_into_chunks(text, max_tokens=350, overlap=0, tokenizer=None):
+    """
+    Splits text into chunks of at most max_tokens units, packing whole paragraphs where they fit.
+    Units are whitespace-separated words, or the tokens of the given Hugging Face fast tokenizer
+    (encoded in one batch per text) so chunks match the model's real budget.
+    A paragraph longer than max_tokens is cut at unit boundaries rather than left to be truncated
+    by the model, and one that doesn't fit next to the overlap is cut where the chunk is full.
+    Each chunk after the first starts with the last `overlap` units of the previous one.
+    Runs in time linear in the length of the text.
+    """
+    if not 0 <= overlap < max_tokens:
+        raise ValueError("overlap must be at least 0 and smaller than max_tokens")
+
+    # Split text into paragraphs, and count the units of each
+    paragraphs = text.split("\n")
+    if tokenizer is None:
+        all_spans = [None] * len(paragraphs)
+        counts = [len(paragraph.split()) for paragraph in paragraphs]
+    else:
+        encoding = tokenizer(paragraphs, add_special_tokens=False, return_offsets_mapping=True)
+        all_spans = [[tuple(span) for span in spans] for spans in encoding['offset_mapping']]
+        counts = [len(spans) for spans in all_spans]
+
+    # Paragraphs longer than the budget are cut into pieces that continue on the same line, leaving room
+    # for the overlap next to each piece
+    pieces = []
+    for paragraph, count, spans in zip(paragraphs, counts, all_spans):
+        if count <= max_tokens:
+            pieces.append(("\n", paragraph, count, spans))
+            continue
+        piece = ("\n", paragraph, count, spans if spans is not None else _get_word_spans(paragraph))
+        for i in range(0, count, max_tokens - overlap):
+            pieces.append(_split_piece(piece, i, i + max_tokens - overlap))
+
+    chunks = []
+    current_pieces = []
+    current_tokens = 0
+
+    # Create chunks that don't exceed the budget, keeping a running count of their units
+    for piece in pieces:
+        while current_tokens + piece[2] > max_tokens:
+            if current_tokens <= overlap:
+                # The next chunk would repeat all of this one: fill it with the start of the piece instead
+                room = max_tokens - current_tokens
+                current_pieces.append(_split_piece(piece, 0, room))
+                piece = _split_piece(piece, room, piece[2])
+            _append_chunk(chunks, current_pieces)
+            # Start the next chunk with the previous one's tail
+            current_pieces = _get_tail_pieces(current_pieces, overlap)
+            current_tokens = sum(tail_piece[2] for tail_piece in current_pieces)
+        current_pieces.append(piece)
+        current_tokens += piece[2]
+
+    # Add the last chunk if it's not empty
+    _append_chunk(chunks, current_pieces)
+
+    return chunks